@@ -0,0 +1,98 @@
+"""
+Per-request cost of the Cache-Control middleware, BaseHTTPMiddleware
+version against the pure ASGI one. Requests are sent straight to the
+ASGI app, so the numbers contain no network or client overhead.
+
+    python benchmarks/cache_control_header.py
+"""
+import asyncio
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from fastapi import FastAPI, Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from middleware import CacheControlHeader  # noqa: E402
+
+REQUESTS = 5000
+
+
+class BaseHTTPCacheControlHeader(BaseHTTPMiddleware):
+    """
+    Previous implementation.
+    """
+    def __init__(self, app, header_value='no-store'):
+        super().__init__(app)
+        self.header_value = header_value
+
+    async def dispatch(self, request: Request, call_next):
+        response = await call_next(request)
+        response.headers["Cache-Control"] = self.header_value
+        return response
+
+
+def build_app(middleware=None) -> FastAPI:
+    app = FastAPI()
+
+    @app.get('/health')
+    async def health():
+        return {'status': 'ok'}
+
+    if middleware:
+        app.add_middleware(middleware, header_value='no-store')
+    return app
+
+
+async def call(app: FastAPI):
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': '/health',
+        'raw_path': b'/health',
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'host', b'testserver')],
+        'client': ('127.0.0.1', 1234),
+        'server': ('testserver', 80),
+    }
+
+    messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # client stays connected, streaming responses wait here until cancelled
+        await asyncio.Event().wait()
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def measure(app: FastAPI) -> float:
+    for _ in range(100):
+        await call(app)
+    start = perf_counter()
+    for _ in range(REQUESTS):
+        await call(app)
+    return (perf_counter() - start) / REQUESTS
+
+
+def main():
+    for name, middleware in (
+        ('no middleware', None),
+        ('BaseHTTPMiddleware', BaseHTTPCacheControlHeader),
+        ('pure ASGI', CacheControlHeader),
+    ):
+        seconds = asyncio.run(measure(build_app(middleware)))
+        print(f'{name:20} {seconds * 1e6:8.1f} us/request')
+
+
+if __name__ == '__main__':
+    main()
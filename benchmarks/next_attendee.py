@@ -0,0 +1,136 @@
+"""
+Pick next attendee in a 1000 attendee room with every order type.
+
+Runs against in-memory mockfirestore, so timings only show in-process cost.
+Documents read per pick is what matters on real Firestore, every streamed
+document is billed and travels over the network.
+
+    python benchmarks/next_attendee.py
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from mockfirestore import MockFirestore  # noqa: E402
+
+import firestore  # noqa: E402
+import schemas  # noqa: E402
+from mirror import MirrorEngine  # noqa: E402
+from queues import QueueEngine  # noqa: E402
+
+ATTENDEES = 1000
+HANDS_UP = 0.3
+ROUNDS = 200
+
+
+class CountingQuery:
+    """Count documents streamed from Firestore."""
+    read = 0
+
+    def __init__(self, query):
+        self.query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self.query, name)
+        if name == 'stream':
+            def stream(*args, **kwargs):
+                for doc in attr(*args, **kwargs):
+                    CountingQuery.read += 1
+                    yield doc
+            return stream
+        if callable(attr):
+            def call(*args, **kwargs):
+                result = attr(*args, **kwargs)
+                # documents read by id, like the room, aren't counted
+                return CountingQuery(result) if hasattr(result, 'stream') else result
+            return call
+        return attr
+
+
+def populate(db) -> str:
+    _, room = db.collection('rooms').add({
+        'name': 'bench', 'profile_id': 'p', **firestore.COUNTERS,
+    })
+    start = datetime(2021, 1, 1)
+    for i in range(ATTENDEES):
+        hand_up = random.random() < HANDS_UP
+        db.collection('attendees').add({
+            'name': f'attendee {i}',
+            'profile_id': f'profile {i}',
+            'room_id': room.id,
+            'created': start,
+            'hand_up': hand_up,
+            'hand_change_timestamp': start + timedelta(seconds=i) if hand_up else None,
+            'answering': False,
+            'answers': random.randint(0, 5),
+            'room_owner_likes': 0,
+            'peer_likes': 0,
+            'random_key': random.random(),
+        })
+    return room.id
+
+
+def stream_room(db, room_id):
+    query = CountingQuery(db.collection('attendees').where('room_id', '==', room_id))
+    return [schemas.Attendee.from_snapshot(doc) for doc in query.stream()]
+
+
+def old_first_arrived(db, room_id):
+    hands = [a for a in stream_room(db, room_id) if a.hand_up]
+    return min(hands, key=lambda a: a.hand_change_timestamp)
+
+
+def old_random_in_queue(db, room_id):
+    return random.choice([a for a in stream_room(db, room_id) if a.hand_up])
+
+
+def old_random_in_room(db, room_id):
+    return random.choice(stream_room(db, room_id))
+
+
+def main():
+    db = MockFirestore()
+    room_id = populate(db)
+    queues = QueueEngine(reconcile_interval=3600)
+    picker = firestore.NextAttendee(
+        room_id=room_id,
+        attendee_id=None,
+        order=firestore.OrderTypes.least_answers,
+        db=db,
+        crud=firestore.Crud(db),
+        queues=queues,
+        # disabled, picks go through Firestore queries
+        mirror=MirrorEngine(db, queues),
+    )
+    picker.queue  # initial load is shared by all in-memory orders
+
+    print(f'{ATTENDEES} attendees, {int(HANDS_UP * 100)}% hands up, {ROUNDS} picks')
+    print(f'{"order":<20}{"variant":<10}{"ms/pick":>10}{"docs/pick":>12}')
+    for order, old in [
+        (firestore.OrderTypes.first_arrived, old_first_arrived),
+        (firestore.OrderTypes.random_in_queue, old_random_in_queue),
+        (firestore.OrderTypes.random_in_room, old_random_in_room),
+    ]:
+        picker.order = order
+        for variant, pick in [
+            ('stream', lambda: old(db, room_id)),
+            ('new', picker.next_attendee),
+        ]:
+            CountingQuery.read = 0
+            db_collection = db.collection
+            if variant == 'new':
+                db.collection = lambda path: CountingQuery(db_collection(path))
+            seconds = timeit(pick, number=ROUNDS)
+            db.collection = db_collection
+            print(
+                f'{order.value:<20}{variant:<10}'
+                f'{seconds / ROUNDS * 1000:>10.3f}{CountingQuery.read / ROUNDS:>12.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
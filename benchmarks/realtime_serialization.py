@@ -0,0 +1,56 @@
+"""
+Convert attendee lists into plain json types for the realtime database,
+json round-trip against the single pass encoder.
+
+    python benchmarks/realtime_serialization.py
+"""
+import sys
+from datetime import datetime, timedelta
+from json import loads
+from pathlib import Path
+from timeit import repeat
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import schemas  # noqa: E402
+
+ROUNDS = 20
+
+
+def attendees(count: int) -> list[schemas.Attendee]:
+    start = datetime(2021, 1, 1)
+    return [
+        schemas.Attendee(
+            id=f'attendee{i}',
+            name=f'Attendee {i}',
+            profile_id=f'profile{i}',
+            room_id='room',
+            created=start + timedelta(seconds=i),
+            hand_up=bool(i % 2),
+            hand_change_timestamp=start + timedelta(minutes=i) if i % 2 else None,
+            answers=i % 5,
+        )
+        for i in range(count)
+    ]
+
+
+def json_round_trip(items):
+    return {i.id: loads(i.json()) for i in items}
+
+
+def single_pass(items):
+    return {i.id: schemas.jsonable(i) for i in items}
+
+
+def main():
+    print(f'{"attendees":>10}{"round-trip ms":>16}{"single pass ms":>16}{"speedup":>10}')
+    for count in (200, 2000):
+        items = attendees(count)
+        assert json_round_trip(items) == single_pass(items)
+        old = min(repeat(lambda: json_round_trip(items), number=ROUNDS, repeat=5)) / ROUNDS
+        new = min(repeat(lambda: single_pass(items), number=ROUNDS, repeat=5)) / ROUNDS
+        print(f'{count:>10}{old * 1000:>16.3f}{new * 1000:>16.3f}{old / new:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
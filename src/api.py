@@ -1,22 +1,29 @@
 import logging
 from typing import Optional
 from fastapi.routing import APIRouter
-from fastapi import status, HTTPException, Depends, Path, Query
+from fastapi import status, HTTPException, Depends, Header, Path, Query
 from fastapi.responses import Response
 from fastapi.security import OAuth2PasswordRequestForm
 
 import authorization
 import schemas
 import firestore
+import firestore_async
 import messaging
+import mirror
+import queues
 import services
 import realtime_db
 import utils
 
+from middleware import cache_control
 from utils import raise_forbidden
 
 logger = logging.getLogger(__name__)
 
+# next_attendee picks again when the picked attendee was taken meanwhile
+ADVANCE_ATTEMPTS = 3
+
 router = APIRouter()
 
 
@@ -48,8 +55,16 @@ def fetch_room(
     return room
 
 
+def invalid_cursor(cursor: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail=f"Cursor {cursor} is not valid.",
+    )
+
+
 @router.get("/health")
-def health_check():
+@cache_control('public, max-age=5')
+async def health_check():
     return {"status": "ok"}
 
 
@@ -57,26 +72,36 @@ def health_check():
     "/rooms",
     response_model=schemas.PaginationContainer,
 )
-def list_rooms(
+async def list_rooms(
     relation: Optional[firestore.RoomRelationTypes] = Query(
         None,
         title='Filter based on profile relation to the room',
     ),
-    auth: authorization.Auth = Depends(),
-    crud: firestore.Crud = Depends(),
+    limit: int = Query(50, ge=1, le=500, title='Number of results per request'),
+    cursor: Optional[str] = Query(None, title='Cursor from the previous page'),
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
 ):
-    if relation == firestore.RoomRelationTypes.created:
-        rooms = crud.list_rooms(auth.profile)
-    elif relation == firestore.RoomRelationTypes.joined:
-        attendees = crud.list_attendees(
-            limit=100, profile_id=auth.profile.id
-        )
-        rooms = crud.fetch_rooms([a.room_id for a in attendees])
-    else:
-        rooms = crud.list_rooms()
+    try:
+        if relation == firestore.RoomRelationTypes.created:
+            rooms = await crud.list_rooms(auth.profile, limit=limit, cursor=cursor)
+            next_cursor = firestore.next_cursor(rooms, limit)
+        elif relation == firestore.RoomRelationTypes.joined:
+            # pages go over attendee records of the profile
+            attendees = await crud.list_attendees(
+                limit=limit, profile_id=auth.profile.id, cursor=cursor,
+            )
+            rooms = await crud.fetch_rooms([a.room_id for a in attendees])
+            next_cursor = firestore.next_cursor(attendees, limit)
+        else:
+            rooms = await crud.list_rooms(limit=limit, cursor=cursor)
+            next_cursor = firestore.next_cursor(rooms, limit)
+    except firestore.InvalidCursor:
+        raise invalid_cursor(cursor)
 
     container = schemas.PaginationContainer(
         result=rooms,
+        cursor=next_cursor,
     )
     return container
 
@@ -88,7 +113,7 @@ def list_rooms(
 def create_room(
     room: schemas.RoomCreate,
 
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     crud: firestore.Crud = Depends(),
     realtime: realtime_db.Crud = Depends(),
 ):
@@ -101,10 +126,10 @@ def create_room(
     "/rooms/{room_id}",
     response_model=schemas.Room,
 )
-def get_room(
+async def get_room(
     room: schemas.Room = Depends(fetch_room),
 
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
 ):
     return room
 
@@ -113,12 +138,25 @@ def get_room(
     "/realtime_room_format/{room_id}",
     response_model=schemas.RealtimeRoom,
 )
+@cache_control('private, no-cache')
 def realtime_room_format(
-    auth: authorization.Auth = Depends(),
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+
+    auth: authorization.Auth = Depends(authorization.authenticate),
     room: schemas.Room = Depends(fetch_room),
     realtime: realtime_db.Crud = Depends(),
 ):
-    return realtime.get_room(room)
+    etag, realtime_room = realtime.get_room_version(room)
+    tags = {tag.strip().removeprefix('W/') for tag in (if_none_match or '').split(',')}
+    if etag in tags or '*' in tags:
+        # polling client has the current room already
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={'ETag': etag},
+        )
+    response.headers['ETag'] = etag
+    return realtime_room
 
 
 @router.post(
@@ -126,7 +164,7 @@ def realtime_room_format(
     response_model=schemas.RealtimeRoom,
 )
 def realtime_room_update(
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     room: schemas.Room = Depends(fetch_room),
     realtime: realtime_db.Crud = Depends(),
 ):
@@ -137,7 +175,7 @@ def realtime_room_update(
 #    "/realtime_room_update",
 #)
 #def all_realtime_room_update(
-#    auth: authorization.Auth = Depends(),
+#    auth: authorization.Auth = Depends(authorization.authenticate),
 #    crud: firestore.Crud = Depends(),
 #    realtime: realtime_db.Crud = Depends(),
 #):
@@ -162,10 +200,12 @@ def next_attendee(
         title='Algorithm used to pick the next attendee.'
     ),
 
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     crud: firestore.Crud = Depends(),
     realtime: realtime_db.Crud = Depends(),
     picker: firestore.NextAttendee = Depends(),
+    queue_engine: queues.QueueEngine = Depends(services.queue_engine),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
 ):
     # Only owner can call next attendee
     if room.profile_id != auth.profile.id:
@@ -190,19 +230,34 @@ def next_attendee(
         # Assume the specific attendee is needed since id was provided
         picker.order = firestore.OrderTypes.specific_attendee
 
-    next_in_queue = picker.next_attendee()
     # even if there is no next attendee we stop all previous answers
-    crud.stop_all_answers(room.id)
-    # TODO: optimize this
-    realtime.set_answering(room, next_in_queue)
-    realtime.set_room_queue(room)
-    if not next_in_queue:
-        return None
+    for _ in range(ADVANCE_ATTEMPTS):
+        picked = picker.next_attendee()
+        try:
+            next_in_queue, stopped = crud.advance_queue(
+                room.id,
+                picked and picked.id,
+                hand_up=picker.needs_hand_up,
+            )
+            break
+        except firestore.NoNextAttendee:
+            # hand went down or a concurrent call took the attendee, pick again
+            queue_engine.remove(room.id, picked.id)
+    else:
+        next_in_queue, stopped = crud.advance_queue(room.id, None)
 
-    crud.start_answer(next_in_queue.id)
-    realtime.set_answering(room, next_in_queue)
-    realtime.set_room_queue(room)
-    return crud.get_attendee(next_in_queue.id)
+    queue_engine.answered(room.id, [a.id for a in stopped])
+    for attendee in stopped:
+        room_mirror.apply(attendee)
+    if next_in_queue:
+        queue_engine.remove(room.id, next_in_queue.id)
+        room_mirror.apply(next_in_queue)
+    # every realtime change goes out in a single update
+    with realtime.batch():
+        realtime.set_answering(room, next_in_queue)
+        realtime.set_room_queue(room)
+
+    return next_in_queue
 
 
 @router.delete(
@@ -210,17 +265,19 @@ def next_attendee(
     status_code=status.HTTP_204_NO_CONTENT,
 )
 def delete_room(
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     room: schemas.Room = Depends(fetch_room),
-    crud: firestore.Crud = Depends(),
     realtime: realtime_db.Crud = Depends(),
+    queue_engine: queues.QueueEngine = Depends(services.queue_engine),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
 ):
     if room.profile_id != auth.profile.id:
         raise_forbidden(f"Room {room.id} doesn't belong to current user.")
 
-    room_id = room.id
-    crud.delete_room(room.id)
-    realtime.delete_room(room_id)
+    deleted = realtime.delete_room(room.id)
+    queue_engine.forget(room.id)
+    room_mirror.forget(room.id)
+    logger.info(f"Room {room.id} deleted with {deleted - 1} attendees.")
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -229,17 +286,22 @@ def delete_room(
     "/attendees",
     response_model=schemas.PaginationContainer,
 )
-def list_attendees(
+async def list_attendees(
     room_id: Optional[str] = Query(None, title='Room id'),
-    limit: int = Query(50, title='Number of results per request'),
+    limit: int = Query(50, ge=1, le=500, title='Number of results per request'),
+    cursor: Optional[str] = Query(None, title='Cursor from the previous page'),
 
-    auth: authorization.Auth = Depends(),
-    crud: firestore.Crud = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
 ):
-    attendees = crud.list_attendees(limit, room_id)
+    try:
+        attendees = await crud.list_attendees(limit, room_id, cursor=cursor)
+    except firestore.InvalidCursor:
+        raise invalid_cursor(cursor)
 
     return schemas.PaginationContainer(
         result=attendees,
+        cursor=firestore.next_cursor(attendees, limit),
     )
 
 
@@ -250,9 +312,10 @@ def list_attendees(
 def create_attendee(
     data: schemas.NewAttendee,
 
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     crud: firestore.Crud = Depends(),
     realtime: realtime_db.Crud = Depends(),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
 ):
     # check the room
     room = fetch_room(data.room_id, crud)
@@ -267,21 +330,62 @@ def create_attendee(
             detail=f"attendees/{original_attendee.id} already joined rooms/{room.id} as profile/{auth.profile.id}"
         )
     new_attendee = crud.create_attendee(room.id, auth.profile)
+    room_mirror.apply(new_attendee)
     realtime.set_room_attendees(room)
 
     return new_attendee
 
 
+@router.post(
+    "/rooms/{room_id}/attendees",
+    response_model=schemas.AttendeeImportResult,
+)
+def import_attendees(
+    data: schemas.AttendeeImport,
+
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    room: schemas.Room = Depends(fetch_room),
+    crud: firestore.Crud = Depends(),
+    realtime: realtime_db.Crud = Depends(),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
+):
+    # Only owner can enroll attendees
+    if room.profile_id != auth.profile.id:
+        raise_forbidden(f"Room {room.id} doesn't belong to current user.")
+
+    profile_ids = list(dict.fromkeys(data.profile_ids))
+    joined = crud.room_profile_ids(room.id)
+    existing = [i for i in profile_ids if i in joined]
+    profiles = crud.fetch_profiles([i for i in profile_ids if i not in joined])
+    found = {p.id for p in profiles}
+
+    created = crud.create_attendees(room.id, profiles)
+    for attendee in created:
+        room_mirror.apply(attendee)
+    if created:
+        realtime.set_room_attendees(room)
+
+    return schemas.AttendeeImportResult(
+        created=created,
+        existing=existing,
+        missing=[i for i in profile_ids if i not in joined and i not in found],
+    )
+
+
 @router.delete("/attendees/{attendee_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_attendee(
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     attendee: schemas.Attendee = Depends(fetch_attendee),
     crud: firestore.Crud = Depends(),
     realtime: realtime_db.Crud = Depends(),
+    queue_engine: queues.QueueEngine = Depends(services.queue_engine),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
 ):
     if attendee.profile_id != auth.profile.id:
         raise_forbidden(f"Attendee {attendee.id} doesn't belong to current user.")
 
+    queue_engine.remove(attendee.room_id, attendee.id)
+    room_mirror.discard(attendee.room_id, attendee.id)
     try:
         room = crud.get_room(attendee.room_id)
     except firestore.NotFound:
@@ -297,8 +401,8 @@ def delete_attendee(
     "/attendees/{attendee_id}",
     response_model=schemas.Attendee,
 )
-def get_attendee(
-    auth: authorization.Auth = Depends(),
+async def get_attendee(
+    auth: authorization.Auth = Depends(authorization.authenticate),
     attendee: schemas.Attendee = Depends(fetch_attendee),
 ) -> schemas.Attendee:
     return attendee
@@ -309,17 +413,21 @@ def get_attendee(
     response_model=schemas.Attendee,
 )
 def hand_toggle(
-    auth: authorization.Auth = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
     attendee: schemas.Attendee = Depends(fetch_attendee),
     crud: firestore.Crud = Depends(),
     message: messaging.Message = Depends(),
     realtime: realtime_db.Crud = Depends(),
+    queue_engine: queues.QueueEngine = Depends(services.queue_engine),
+    room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
 ):
     if attendee.profile_id != auth.profile.id:
         raise_forbidden(f"Attendee {attendee.id} doesn't belong to current user.")
     room = fetch_room(attendee.room_id, crud)
     updated_attendee = crud.hand_toggle(attendee)
-    realtime.set_room_queue(room)
+    queue_engine.update(updated_attendee)
+    room_mirror.apply(updated_attendee)
+    realtime.publish_room_queue(room)
     message.maybe_notify_instructor(updated_attendee)
 
     return updated_attendee
@@ -329,8 +437,8 @@ def hand_toggle(
     "/profile",
     response_model=schemas.Profile,
 )
-def get_profile(
-    auth: authorization.Auth = Depends(),
+async def get_profile(
+    auth: authorization.Auth = Depends(authorization.authenticate),
 ):
     return auth.profile
 
@@ -339,12 +447,23 @@ def get_profile(
     "/profile/notification_tokens",
     response_model=schemas.PaginationContainer,
 )
-def list_notification_tokens(
-    auth: authorization.Auth = Depends(),
-    crud: firestore.Crud = Depends(),
+async def list_notification_tokens(
+    limit: int = Query(50, ge=1, le=500, title='Number of results per request'),
+    cursor: Optional[str] = Query(None, title='Cursor from the previous page'),
+
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
 ):
+    try:
+        tokens = await crud.list_notification_tokens(
+            auth.profile.id, limit=limit, cursor=cursor,
+        )
+    except firestore.InvalidCursor:
+        raise invalid_cursor(cursor)
+
     return schemas.PaginationContainer(
-        result=crud.list_notification_tokens(auth.profile.id)
+        result=tokens,
+        cursor=firestore.next_cursor(tokens, limit),
     )
 
 
@@ -352,14 +471,14 @@ def list_notification_tokens(
     "/profile/notification_tokens",
     response_model=schemas.NotificationToken,
 )
-def create_notification_token(
+async def create_notification_token(
     data: schemas.NotificationTokenAdd,
 
-    auth: authorization.Auth = Depends(),
-    crud: firestore.Crud = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
 ):
     try:
-        token = crud.get_notification_token(data.token)
+        token = await crud.get_notification_token(data.token)
     except firestore.NotFound:
         pass
     else:
@@ -368,7 +487,7 @@ def create_notification_token(
 
         return token
 
-    token = crud.create_notification_token(auth.profile, data.token)
+    token = await crud.create_notification_token(auth.profile, data.token)
     return token
 
 
@@ -376,14 +495,14 @@ def create_notification_token(
     "/profile/notification_tokens/{token}",
     status_code=status.HTTP_204_NO_CONTENT,
 )
-def delete_notification_token(
+async def delete_notification_token(
     token: str = Path(..., title="Notification token string"),
 
-    auth: authorization.Auth = Depends(),
-    crud: firestore.Crud = Depends(),
+    auth: authorization.Auth = Depends(authorization.authenticate),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
 ):
     try:
-        token = crud.get_notification_token(token)
+        token = await crud.get_notification_token(token)
     except firestore.NotFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -393,7 +512,7 @@ def delete_notification_token(
     if token.profile_id != auth.profile.id:
         raise_forbidden(f"Token doesn't belong to current user.")
 
-    crud.delete_notification_token(token.id)
+    await crud.delete_notification_token(token.id)
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
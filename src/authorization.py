@@ -1,17 +1,21 @@
 import logging
+import hashlib
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2
 from firebase_admin.auth import UserRecord, UserNotFoundError
+from starlette.concurrency import run_in_threadpool
 
-import firestore
+import firestore_async
+import schemas
 import services
+from cache import TTLCache
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 logger = logging.getLogger(__name__)
 
 
-def auth_header(
+async def auth_header(
     header_body: str = Depends(OAuth2())
 ):
     try:
@@ -37,13 +41,20 @@ def auth_header(
     return token
 
 
-def uid_from_authorization_token(
+async def uid_from_authorization_token(
     auth=Depends(services.auth_transport),
     form: str = Depends(oauth2_scheme),
     token: str = Depends(auth_header),
+    cache: TTLCache = Depends(services.token_cache),
 ) -> str:
+    # Never keep raw tokens in memory longer than needed, hash is enough for lookups.
+    key = hashlib.sha256(token.encode()).hexdigest()
+    if decoded_token := cache.get(key):
+        return decoded_token['uid']
+
     try:
-        decoded_token = auth.verify_id_token(token)
+        # firebase_admin has no async auth client
+        decoded_token = await run_in_threadpool(auth.verify_id_token, token)
     except Exception as e:
         # verify_id_token can raise a bunch of different errors
         # For now we just catch them all and report it in detail with 401 status.
@@ -55,15 +66,22 @@ def uid_from_authorization_token(
             headers={"WWW-Authenticate": "Bearer"},
 
         )
+    # Tokens without expiration claim are not cached
+    if expires_at := decoded_token.get('exp'):
+        cache.set(key, decoded_token, expires_at=expires_at)
     return decoded_token['uid']
 
 
-def user_record(
+async def user_record(
     uid: str = Depends(uid_from_authorization_token),
-    auth=Depends(services.auth_transport)
+    auth=Depends(services.auth_transport),
+    cache: TTLCache = Depends(services.profile_cache),
 ) -> UserRecord:
+    if record := cache.get(('user_record', uid)):
+        return record
+
     try:
-        record = auth.get_user(uid)
+        record = await run_in_threadpool(auth.get_user, uid)
     except UserNotFoundError as e:
         msg = f"User is not registered with the app: {repr(e)}"
         logger.warning(f"User is not registered with the app: {repr(e)}")
@@ -71,15 +89,39 @@ def user_record(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=msg,
         )
+    cache.set(('user_record', uid), record)
     return record
 
 
+def invalidate_profile(cache: TTLCache, uid: str) -> None:
+    """
+    Drop memoized user record and profile,
+    so the next request reads them from firebase again.
+    """
+    cache.invalidate(('user_record', uid))
+    cache.invalidate(('profile', uid))
+
+
 class Auth:
-    def __init__(
-        self,
-        firebase_auth=Depends(services.auth_transport),
-        user: UserRecord = Depends(user_record),
-        crud: firestore.Crud = Depends(),
-    ):
-        self.profile = crud.get_or_create_profile(user)
+    """
+    Profile of the authenticated user, endpoints get it from `authenticate`.
+    """
+    def __init__(self, profile: schemas.Profile, firebase_auth):
+        self.profile = profile
         self._transport = firebase_auth
+
+
+async def authenticate(
+    firebase_auth=Depends(services.auth_transport),
+    user: UserRecord = Depends(user_record),
+    crud: firestore_async.AsyncCrud = Depends(firestore_async.crud),
+    cache: TTLCache = Depends(services.profile_cache),
+) -> Auth:
+    """
+    Runs on the event loop, a class dependency would take a threadpool
+    worker, and reads the profile with the async Firestore path.
+    """
+    if not (profile := cache.get(('profile', user.uid))):
+        profile = await crud.get_or_create_profile(user)
+        cache.set(('profile', user.uid), profile)
+    return Auth(profile, firebase_auth)
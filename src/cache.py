@@ -0,0 +1,176 @@
+import threading
+from contextlib import contextmanager
+from time import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+
+class TTLCache:
+    """
+    Size bounded LRU cache where every entry has its own expiration time.
+    Entries are evicted when they expire or when the cache is full.
+    Shared between threadpool workers, so every operation takes a lock.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(
+        self,
+        key: Hashable,
+        default: Any = None,
+        count: bool = True,
+    ) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: Optional[float] = None,
+        expires_at: Optional[float] = None,
+    ) -> None:
+        """
+        Store value for `ttl` seconds (cache default if not set), but never
+        past `expires_at` unix timestamp.
+        """
+        now = time()
+        deadline = now + (self.ttl if ttl is None else ttl)
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        if deadline <= now:
+            return
+
+        with self._lock:
+            self._data[key] = (deadline, value)
+            self._data.move_to_end(key)
+            self._evict(now)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _evict(self, now: float) -> None:
+        if len(self._data) <= self.maxsize:
+            return
+        expired = [k for k, (exp, _) in self._data.items() if exp <= now]
+        for key in expired:
+            del self._data[key]
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class SnapshotCache(TTLCache):
+    """
+    TTLCache for values read from a store the process also writes to.
+    Readers note `started()` before reading and pass it to `set`,
+    a value read before its key was last invalidated is not stored,
+    so a slow read never brings back what a write just replaced.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        # key -> unix time of the last invalidation, oldest first
+        self._invalidated: OrderedDict[Hashable, float] = OrderedDict()
+        self._cleared = 0.0
+
+    @staticmethod
+    def started() -> float:
+        return time()
+
+    def set(self, key: Hashable, value: Any, started: Optional[float] = None) -> None:
+        """
+        Store value read since `started` for at most `ttl` seconds from then.
+        """
+        now = time()
+        if started is None:
+            started = now
+        deadline = started + self.ttl
+        with self._lock:
+            if started <= max(self._invalidated.get(key, 0.0), self._cleared):
+                return
+            if deadline <= now:
+                return
+            self._data[key] = (deadline, value)
+            self._data.move_to_end(key)
+            self._evict(now)
+
+    def invalidate(self, key: Hashable) -> None:
+        now = time()
+        with self._lock:
+            self._data.pop(key, None)
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = now
+            # reads started before these have expired anyway
+            while self._invalidated:
+                oldest = next(iter(self._invalidated))
+                if self._invalidated[oldest] > now - self.ttl:
+                    break
+                del self._invalidated[oldest]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._invalidated.clear()
+            self._cleared = time()
+
+
+class KeyedLocks:
+    """
+    Locks by key from a fixed pool, keys sharing a stripe share the lock.
+    Memory stays bounded however many keys there are.
+    """
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, keys: Optional[Iterable[Hashable]] = None):
+        """
+        Hold locks of all keys, every lock if keys are None.
+        Locks are taken in pool order, so holders never deadlock.
+        """
+        if keys is None:
+            stripes = range(len(self._locks))
+        else:
+            stripes = sorted({hash(key) % len(self._locks) for key in keys})
+        locks = [self._locks[i] for i in stripes]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
@@ -33,6 +33,71 @@ class Settings(BaseSettings):
     description: str = description
     origins: List[str] = origins
 
+    # serve Firestore only endpoints with the async client
+    firestore_async: bool = False
+
+    # verified id tokens are reused until they expire,
+    # but no longer than token_cache_ttl seconds
+    token_cache_size: int = 4096
+    token_cache_ttl: int = 300
+    # firebase user records and profiles are reused for a short time
+    profile_cache_size: int = 4096
+    profile_cache_ttl: int = 60
+
+    # in-process hand up queues are reloaded from Firestore after this many seconds
+    queue_reconcile_interval: int = 10
+    queue_max_rooms: int = 1000
+    # watch attendees of active rooms instead of querying them on every sync
+    room_mirror: bool = False
+    room_mirror_max_rooms: int = 100
+
+    # last written realtime attendee lists, only changes are sent while remembered
+    realtime_snapshot_rooms: int = 1000
+    realtime_snapshot_ttl: int = 60
+    # rooms read from realtime db, writes of this process replace them,
+    # writes of other processes show up after realtime_room_cache_ttl seconds
+    realtime_room_cache_size: int = 1000
+    realtime_room_cache_ttl: int = 5
+    # queue syncs of a room arriving within realtime_debounce_window seconds
+    # are written once, at most realtime_debounce_max_delay seconds late, 0 turns it off
+    realtime_debounce_window: float = 0.1
+    realtime_debounce_max_delay: float = 0.5
+
+    # push notifications are sent by background threads
+    push_workers: int = 2
+    # pushes waiting for a worker, when full requests wait
+    # push_enqueue_timeout seconds and then drop the push
+    push_queue_size: int = 1000
+    push_enqueue_timeout: float = 0.05
+    # failed sends are retried after push_retry_delay, doubled every attempt
+    push_retries: int = 3
+    push_retry_delay: float = 0.5
+    # a device gets one push per window, hand ups in between are summarized
+    push_coalesce_window: float = 5
+
+    # production server, see server_prod.py
+    host: str = '0.0.0.0'
+    # Cloud Run passes the port in PORT
+    port: int = 8080
+    # worker processes. Queue engine, room mirror, push throttle,
+    # debounced publishing and caches live in each process and assume
+    # it is the only writer of its rooms, so more than one worker or
+    # instance lets them diverge. Deploy with --max-instances 1.
+    server_workers: int = 1
+    # 'auto' picks uvloop and httptools when installed
+    server_loop: str = 'auto'
+    server_http: str = 'auto'
+    # seconds idle connections are kept open
+    server_keep_alive: int = 5
+    # pending connections queued by the socket
+    server_backlog: int = 2048
+    server_log_level: str = 'info'
+
+    firebase_credentials: Path = Path('/keys/service_account_key.json')
+    firebase_database_url: str = (
+        'https://rita-iu-default-rtdb.europe-west1.firebasedatabase.app/'
+    )
+
     class Config:
         env_file = ".env"
 
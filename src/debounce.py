@@ -0,0 +1,75 @@
+import logging
+import threading
+from time import time
+from typing import Callable, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Debouncer:
+    """
+    Collapses bursts of calls per key. Only the last callable given for a
+    key runs, once no other arrived for `window` seconds, but never later
+    than `max_delay` seconds after the first call of the burst.
+    Callables run in timer threads, a zero window runs them right away.
+    """
+    def __init__(self, window: float = 0.1, max_delay: float = 0.5):
+        self.window = window
+        self.max_delay = max_delay
+        # key -> [latest run time, planned run time, callable]
+        self._pending: dict[Hashable, list] = {}
+        self._lock = threading.Lock()
+
+    def call(self, key: Hashable, func: Callable[[], None]) -> None:
+        if self.window <= 0:
+            func()
+            return
+
+        now = time()
+        with self._lock:
+            if pending := self._pending.get(key):
+                pending[1] = min(now + self.window, pending[0])
+                pending[2] = func
+                return
+            delay = min(self.window, self.max_delay)
+            self._pending[key] = [now + self.max_delay, now + delay, func]
+        self._schedule(key, delay)
+
+    def _schedule(self, key: Hashable, delay: float) -> None:
+        timer = threading.Timer(delay, self._fire, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _fire(self, key: Hashable) -> None:
+        with self._lock:
+            if (pending := self._pending.get(key)) is None:
+                # flushed meanwhile
+                return
+            wait = pending[1] - time()
+            if wait <= 0:
+                del self._pending[key]
+        if wait > 0:
+            # more calls came in, wait for the burst to settle
+            self._schedule(key, wait)
+            return
+        self._run(pending[2])
+
+    @staticmethod
+    def _run(func: Callable[[], None]) -> None:
+        try:
+            func()
+        except Exception:
+            logger.exception("Debounced call failed.")
+
+    def flush(self, keys: Optional[list[Hashable]] = None) -> None:
+        """
+        Run pending calls of keys now, all keys if not given.
+        """
+        with self._lock:
+            funcs = [
+                pending[2]
+                for key in list(self._pending if keys is None else keys)
+                if (pending := self._pending.pop(key, None))
+            ]
+        for func in funcs:
+            self._run(func)
@@ -0,0 +1,241 @@
+import logging
+import queue
+import threading
+from time import sleep, time
+from typing import Any, Callable, Hashable, Optional
+
+from firebase_admin import exceptions, messaging
+
+import schemas
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# FCM errors worth another attempt, everything else is dropped right away
+RETRY_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.ResourceExhaustedError,
+)
+
+# FCM accepts at most this many tokens in one multicast
+MULTICAST_LIMIT = 500
+
+# errors of single tokens which will never receive a push again
+DEAD_TOKEN_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+)
+# FCM also rejects bad messages with it, so it means a malformed
+# token only when other tokens got the same message
+INVALID_TOKEN_ERRORS = (
+    exceptions.InvalidArgumentError,
+)
+
+SentCallback = Callable[[list[schemas.NotificationToken], Any], None]
+Summarize = Callable[[list[Hashable]], dict]
+
+
+class PushDispatcher:
+    """
+    Sends push notifications from background threads, so requests
+    don't wait for FCM. Pending pushes are kept in a bounded queue,
+    when it is full `submit` waits `enqueue_timeout` seconds for a free
+    slot and then drops the push. Failed sends are retried with
+    exponential backoff. Worker threads start with the first push.
+    """
+    def __init__(
+        self,
+        transport,
+        workers: int = 2,
+        max_pending: int = 1000,
+        retries: int = 3,
+        retry_delay: float = 0.5,
+        enqueue_timeout: float = 0.05,
+    ):
+        self.transport = transport
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.enqueue_timeout = enqueue_timeout
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        tokens: list[schemas.NotificationToken],
+        data: dict,
+        on_sent: Optional[SentCallback] = None,
+    ) -> bool:
+        """
+        Queue a multicast to tokens, `on_sent(tokens, response)` is called
+        by the worker after delivery. Tokens over the FCM limit are split
+        into several multicasts. Return False if any of them was dropped.
+        """
+        self._start()
+        queued = True
+        for i in range(0, len(tokens), MULTICAST_LIMIT):
+            chunk = tokens[i:i + MULTICAST_LIMIT]
+            try:
+                self._queue.put((chunk, data, on_sent), timeout=self.enqueue_timeout)
+            except queue.Full:
+                self.dropped += 1
+                logger.warning(f"Push queue is full, dropped push to {len(chunk)} tokens.")
+                queued = False
+        return queued
+
+    def join(self) -> None:
+        """
+        Wait until every queued push is delivered or given up.
+        """
+        self._queue.join()
+
+    def close(self) -> None:
+        """
+        Deliver queued pushes and stop the workers.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _start(self) -> None:
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._deliver(*job)
+            except Exception:
+                logger.exception("Push delivery failed.")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(
+        self,
+        tokens: list[schemas.NotificationToken],
+        data: dict,
+        on_sent: Optional[SentCallback],
+    ) -> None:
+        message = self.transport.MulticastMessage(
+            data=data,
+            tokens=[t.id for t in tokens],
+        )
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.transport.send_multicast(message)
+                break
+            except RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Push failed, retrying: {repr(e)}")
+                sleep(self.retry_delay * 2 ** attempt)
+
+        if on_sent:
+            on_sent(tokens, response)
+
+
+def dead_tokens(
+    tokens: list[schemas.NotificationToken],
+    response: messaging.BatchResponse,
+) -> list[schemas.NotificationToken]:
+    """
+    Tokens FCM rejected for good, responses come in the order of tokens.
+    """
+    dead = DEAD_TOKEN_ERRORS
+    if response.success_count:
+        dead += INVALID_TOKEN_ERRORS
+    return [
+        token
+        for token, sent in zip(tokens, response.responses)
+        if not sent.success and isinstance(sent.exception, dead)
+    ]
+
+
+class PushThrottle:
+    """
+    Every token gets at most one push per `window` seconds.
+    Items arriving while a token waits are collected and sent as one
+    summarized push when its window ends, tokens with the same items
+    share a multicast (and `on_sent` of one of them). Last send time is known from the token document
+    and from sends of this process, which the document may not show yet.
+    """
+    def __init__(
+        self,
+        dispatcher: PushDispatcher,
+        window: float = 5,
+        max_tokens: int = 10000,
+    ):
+        self.dispatcher = dispatcher
+        self.window = window
+        # token id -> unix time of the last push sent by this process
+        self._sent = TTLCache(maxsize=max_tokens, ttl=window)
+        # token id -> [token, items, summarize, on_sent]
+        self._pending: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _last_sent(self, token: schemas.NotificationToken) -> float:
+        last = self._sent.get(token.id, 0.0, count=False)
+        if token.last_message_timestamp:
+            last = max(last, token.last_message_timestamp.timestamp())
+        return last
+
+    def notify(
+        self,
+        tokens: list[schemas.NotificationToken],
+        item: Hashable,
+        summarize: Summarize,
+        on_sent: Optional[SentCallback] = None,
+    ) -> bool:
+        """
+        Push `summarize([item])` to tokens which are free to receive,
+        queue the item for the others. Return True if anything was sent now.
+        """
+        now = time()
+        ready = []
+        with self._lock:
+            for token in tokens:
+                if pending := self._pending.get(token.id):
+                    pending[1].append(item)
+                    continue
+                wait = self._last_sent(token) + self.window - now
+                if wait <= 0:
+                    self._sent.set(token.id, now)
+                    ready.append(token)
+                    continue
+                self._pending[token.id] = [token, [item], summarize, on_sent]
+                timer = threading.Timer(wait, self.flush, args=([token.id],))
+                timer.daemon = True
+                timer.start()
+
+        return bool(ready) and self.dispatcher.submit(ready, summarize([item]), on_sent)
+
+    def flush(self, token_ids: Optional[list[str]] = None) -> None:
+        """
+        Send collected items of tokens now, all tokens if not given.
+        """
+        now = time()
+        # (items, summarize) -> [tokens, on_sent]
+        groups: dict[tuple, list] = {}
+        with self._lock:
+            for token_id in list(self._pending if token_ids is None else token_ids):
+                if pending := self._pending.pop(token_id, None):
+                    token, items, summarize, on_sent = pending
+                    self._sent.set(token_id, now)
+                    group = groups.setdefault((tuple(items), summarize), [[], on_sent])
+                    group[0].append(token)
+
+        for (items, summarize), (tokens, on_sent) in groups.items():
+            self.dispatcher.submit(tokens, summarize(list(items)), on_sent)
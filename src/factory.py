@@ -1,4 +1,4 @@
-from firebase_admin import initialize_app as init_firebase
+import firebase_admin
 from firebase_admin import credentials
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -42,12 +42,23 @@ def prod_app():
     #json_logging.init_request_instrument(
     #    app, exclude_url_patterns=[r'^/exclude_from_request_instrumentation']
     #)
-    cred = credentials.Certificate('/keys/service_account_key.json')
-    init_firebase(
-        cred,
-        {
-            'databaseURL': 'https://rita-iu-default-rtdb.europe-west1.firebasedatabase.app/',
-        }
-    )
-    services.connect(app)
+    init_firebase(settings)
+    services.connect(app, app_settings=settings)
     return app
+
+
+def init_firebase(settings: config.Settings):
+    """
+    Initialize default firebase app of this process once.
+    Every server worker calls `prod_app` after it started,
+    so gRPC channels are never shared with a parent process.
+    """
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(
+            credentials.Certificate(str(settings.firebase_credentials)),
+            {
+                'databaseURL': settings.firebase_database_url,
+            }
+        )
@@ -1,14 +1,30 @@
 import fastapi
+import binascii
+import random
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from fastapi import Depends
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, timezone
 from firebase_admin.auth import UserRecord
 from google.cloud.firestore import Client as FirestoreDb
-from google.cloud.firestore import Query, Increment
+from google.cloud.firestore import Query, Increment, Transaction, transactional
 
 import schemas
 import services
+from mirror import MirrorEngine
+from queues import QueueEngine, RoomQueue
+
+# Firestore limit of operations in a single write batch
+BATCH_SIZE = 500
+# Number of documents read by a single get_all call and parallel calls limit
+FETCH_CHUNK_SIZE = 100
+FETCH_WORKERS = 4
+# Number of raised hands loaded into the in-process room queue
+QUEUE_LOAD_LIMIT = 1000
+# Counters kept on room documents, see Crud._count
+COUNTERS = {'attendee_count': 0, 'hand_up_count': 0, 'answering_id': None}
 
 
 class NotFound(Exception):
@@ -23,17 +39,114 @@ class NoNextAttendee(Exception):
     pass
 
 
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(doc_id: str) -> str:
+    return urlsafe_b64encode(doc_id.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    Document id from the cursor, ids which can't name a document are invalid.
+    """
+    try:
+        doc_id = urlsafe_b64decode(cursor.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise InvalidCursor
+    if not doc_id or '/' in doc_id or doc_id in ('.', '..'):
+        raise InvalidCursor
+    return doc_id
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def stored_datetime(value: datetime) -> datetime:
+    """
+    Datetime as Firestore reads it back, aware and in UTC.
+    Naive datetimes are stored as UTC.
+    """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def written(data: dict, current: Optional[dict] = None) -> dict:
+    """
+    Fields of a document after `data` is written over `current` ones,
+    transforms like Increment are resolved locally instead of reading back.
+    """
+    fields = dict(current or {})
+    for field, value in data.items():
+        if isinstance(value, Increment):
+            value = (fields.get(field) or 0) + value.value
+        fields[field] = value
+    return {
+        field: stored_datetime(value) if isinstance(value, datetime) else value
+        for field, value in fields.items()
+    }
+
+
+def decode_attendee(doc, records: bool = False) -> schemas.Attendee:
+    """
+    Attendees read by list queries were written by us, so validation is skipped.
+    """
+    if records:
+        return schemas.Attendee.record_from_snapshot(doc)
+    return schemas.Attendee.from_snapshot(doc, trusted=True)
+
+
+def next_cursor(items: list, limit: Optional[int]) -> Optional[str]:
+    """
+    Opaque cursor pointing after the last item of a full page.
+    Partial page means there is nothing left to read.
+    """
+    if not limit or len(items) < limit:
+        return None
+    return encode_cursor(items[-1].id)
+
+
 class RoomRelationTypes(str, Enum):
     joined: str = "joined"
     created: str = "created"
 
 
 class Crud:
+    """
+    FastAPI builds one Crud per request and shares it between dependencies,
+    so documents read by id are remembered for the rest of the request.
+    Writes of the request replace or drop remembered documents,
+    nothing is kept between requests.
+    """
     def __init__(
         self,
         db: FirestoreDb = Depends(services.firestore_transport),
     ):
         self.db = db
+        # (collection, document id) -> model, None when document doesn't exist
+        self._docs: dict[tuple[str, str], Optional[schemas.FirebaseModel]] = {}
+        # rooms known to store counters, see upgrade_room
+        self._counted: set[str] = set()
+
+    def _get(self, collection: str, doc_id: str, model: type):
+        key = (collection, doc_id)
+        if key not in self._docs:
+            doc = self.db.collection(collection).document(doc_id).get()
+            self._docs[key] = model.from_snapshot(doc) if doc.exists else None
+        item = self._docs[key]
+        if item is None:
+            raise NotFound()
+        return item
+
+    def _remember(self, collection: str, item: schemas.FirebaseModel):
+        self._docs[(collection, item.id)] = item
+        return item
+
+    def _forget(self, collection: str, doc_id: str) -> None:
+        self._docs.pop((collection, doc_id), None)
 
     def get_or_create_profile(
         self,
@@ -45,33 +158,85 @@ class Crud:
         name_from_email = name_from_email.replace('_', ' ')
 
         snapshot = ref.get()
-        if not snapshot.exists:
-            ref.set({
-                'display_name': user_info.display_name or name_from_email,
-                'notification_token': None,
-            })
-            snapshot = ref.get()
-        return schemas.Profile.from_snapshot(snapshot)
+        if snapshot.exists:
+            return schemas.Profile.from_snapshot(snapshot)
+
+        data = {
+            'display_name': user_info.display_name or name_from_email,
+            'notification_token': None,
+        }
+        ref.set(data)
+        return schemas.Profile(id=ref.id, **data)
+
+    def _start_after(self, query, collection: str, cursor: Optional[str]):
+        """
+        Continue query after the document encoded in the cursor.
+        """
+        if not cursor:
+            return query
+        doc = self.db.collection(collection).document(decode_cursor(cursor)).get()
+        if not doc.exists:
+            raise InvalidCursor
+        return query.start_after(doc)
 
     def list_rooms(
         self,
         profile: Optional[schemas.Profile] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
     ) -> List[schemas.Room]:
         query = self.db.collection('rooms').order_by('created')
         if profile:
             query = query.where('profile_id', '==', profile.id)
+        query = self._start_after(query, 'rooms', cursor)
+        if limit:
+            query = query.limit(limit)
 
-        rooms = [schemas.Room.from_snapshot(doc) for doc in query.stream()]
+        rooms = [schemas.Room.from_snapshot(doc, trusted=True) for doc in query.stream()]
         return rooms
 
     def fetch_rooms(
         self,
         ids: List[str],
+        chunk_size: int = FETCH_CHUNK_SIZE,
     ) -> List[schemas.Room]:
-        query = self.db.collection('rooms')
-        docs = [query.document(i).get() for i in ids]
-        rooms = [schemas.Room.from_snapshot(doc) for doc in docs if doc.exists]
-        return rooms
+        return self._fetch('rooms', schemas.Room, ids, chunk_size)
+
+    def fetch_profiles(
+        self,
+        ids: List[str],
+        chunk_size: int = FETCH_CHUNK_SIZE,
+    ) -> List[schemas.Profile]:
+        return self._fetch('profiles', schemas.Profile, ids, chunk_size)
+
+    def _fetch(
+        self,
+        collection_name: str,
+        model: type,
+        ids: List[str],
+        chunk_size: int,
+    ) -> list:
+        """
+        Read documents with batched get_all calls, one per chunk of ids.
+        Several chunks are fetched concurrently.
+        Result keeps order of ids without duplicates and missing documents.
+        """
+        ids = list(dict.fromkeys(ids))
+        collection = self.db.collection(collection_name)
+
+        def fetch(chunk: List[str]) -> list:
+            return list(self.db.get_all([collection.document(i) for i in chunk]))
+
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), FETCH_WORKERS)) as pool:
+                pages = list(pool.map(fetch, chunks))
+        else:
+            pages = [fetch(chunk) for chunk in chunks]
+
+        # get_all doesn't keep order of references
+        docs = {doc.id: doc for page in pages for doc in page if doc.exists}
+        return [model.from_snapshot(docs[i], trusted=True) for i in ids if i in docs]
 
     def create_room(
         self,
@@ -79,35 +244,156 @@ class Crud:
         profile: schemas.Profile,
     ) -> schemas.Room:
         ref = self.db.collection('rooms').document()
-        ref.set({
+        data = {
             'name': new_room.name,
             'profile_id': profile.id,
-            'created': datetime.now()
-        })
-        return schemas.Room.from_snapshot(ref.get())
+            'created': utc_now(),
+            **COUNTERS,
+        }
+        ref.set(data)
+        return self._remember('rooms', schemas.Room(id=ref.id, **written(data)))
 
     def get_room(self, room_id: str) -> schemas.Room:
+        key = ('rooms', room_id)
+        if key not in self._docs:
+            doc = self.db.collection('rooms').document(room_id).get()
+            self._docs[key] = schemas.Room.from_snapshot(doc) if doc.exists else None
+            if doc.exists:
+                # counters come with the same snapshot
+                self._remember('room_counters', schemas.RoomCounters.from_snapshot(doc))
+        return self._get('rooms', room_id, schemas.Room)
+
+    def get_room_counters(self, room_id: str) -> schemas.RoomCounters:
+        """
+        Counters read with the room earlier in the request are reused
+        until the request writes them.
+        """
+        if (counters := self._docs.get(('room_counters', room_id))) is not None:
+            return counters
         doc = self.db.collection('rooms').document(room_id).get()
         if not doc.exists:
             raise NotFound()
-        return schemas.Room.from_snapshot(doc)
+        return self._remember('room_counters', schemas.RoomCounters.from_snapshot(doc))
+
+    def upgrade_room(self, room_id: str) -> bool:
+        """
+        Make sure counters are stored on the room before transactions
+        increment them without reading the room, which would make every
+        attendee write contend on it. Rooms created before counters existed
+        are counted from their attendees once. Those rooms may also have
+        attendees older than random_key, they get keys first, so a room
+        with counters has keys on all of its attendees.
+        Return False if the room doesn't exist.
+        """
+        if room_id in self._counted:
+            return True
+        try:
+            counters = self.get_room_counters(room_id)
+        except NotFound:
+            return False
+        if counters.attendee_count is None or counters.hand_up_count is None:
+            self.backfill_random_keys(room_id)
+            self._backfill_counters(room_id)
+        self._counted.add(room_id)
+        return True
+
+    def _backfill_counters(self, room_id: str) -> None:
+        ref = self.db.collection('rooms').document(room_id)
+        query = self.db.collection('attendees').where('room_id', '==', room_id)
+
+        @transactional
+        def backfill(transaction: Transaction) -> None:
+            room = next(iter(transaction.get(ref)), None)
+            if room is None or not room.exists:
+                return
+            data = room.to_dict()
+            if all(field in data for field in COUNTERS):
+                # counted by a concurrent request
+                return
+            attendees = {doc.id: doc.to_dict() for doc in transaction.get(query)}
+            transaction.update(ref, {
+                'attendee_count': len(attendees),
+                'hand_up_count': sum(1 for a in attendees.values() if a.get('hand_up')),
+                'answering_id': next(
+                    (i for i, a in attendees.items() if a.get('answering')), None,
+                ),
+            })
 
-    def delete_room(self, room_id: str) -> None:
-        self.db.collection('rooms').document(room_id).delete()
-        # TODO: use transaction and batch
+        backfill(self.db.transaction())
+        self._forget('room_counters', room_id)
+
+    def _count(
+        self,
+        transaction: Transaction,
+        room_id: str,
+        counted: bool,
+        attendees: int = 0,
+        hands_up: int = 0,
+        **fields,
+    ) -> None:
+        """
+        Queue counter changes into transaction, `counted` comes from
+        `upgrade_room`. Deltas are derived from attendee documents
+        the transaction read, the room itself isn't read.
+        """
+        if not counted:
+            return
+        update = {
+            field: Increment(delta)
+            for field, delta in (
+                ('attendee_count', attendees),
+                ('hand_up_count', hands_up),
+            )
+            if delta
+        }
+        update.update(fields)
+        if update:
+            transaction.update(self.db.collection('rooms').document(room_id), update)
+        self._forget('room_counters', room_id)
+
+    def delete_room(self, room_id: str) -> int:
+        """
+        Delete room and all of its attendees with write batches.
+        Attendees are removed page by page and the room goes with the last page,
+        so if something fails the room still exists and deletion can be repeated.
+        Return number of deleted documents.
+        """
+        page_size = BATCH_SIZE - 1
         query = self.db.collection('attendees').where(
             'room_id', '==', room_id
-        )
-        for a in query.stream():
-            a.reference.delete()
+        ).limit(page_size)
+
+        deleted = 0
+        while True:
+            # deleted docs drop out of the query, so it always returns the next page
+            docs = list(query.stream())
+            batch = self.db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+                self._forget('attendees', doc.id)
+            last_page = len(docs) < page_size
+            if last_page:
+                batch.delete(self.db.collection('rooms').document(room_id))
+                self._forget('rooms', room_id)
+                self._forget('room_counters', room_id)
+                self._counted.discard(room_id)
+            batch.commit()
+            deleted += len(docs)
+            if last_page:
+                return deleted + 1
 
     def list_attendees(
         self,
         limit: int,
         room_id: Optional[str] = None,
         profile_id: Optional[str] = None,
-        descending: bool = True
+        descending: bool = True,
+        cursor: Optional[str] = None,
+        records: bool = False,
     ) -> list[schemas.Attendee]:
+        """
+        With `records` attendees are read-only `schemas.Record`s.
+        """
         query = self.db.collection('attendees')
         if room_id:
             query = query.where(
@@ -120,38 +406,131 @@ class Crud:
         query = query.order_by(
             'created',
             direction=descending and Query.DESCENDING or Query.ASCENDING,
-        ).limit(limit)
+        )
+        query = self._start_after(query, 'attendees', cursor).limit(limit)
         docs = list(query.stream())
 
-        return [schemas.Attendee.from_snapshot(doc) for doc in docs]
+        return [decode_attendee(doc, records) for doc in docs]
 
     def create_attendee(
         self,
         room_id: str,
         profile: schemas.Profile,
     ) -> schemas.Attendee:
-        attendee = self.db.collection('attendees').document()
-        attendee.set({
-            'name': profile.display_name,
-            'profile_id': profile.id,
-            'room_id': room_id,
-            'created': datetime.now(),
-            'hand_up': False,
-            'answering': False,
-            'answers': 0,
-            'room_owner_likes': 0,
-            'peer_likes': 0
-        })
-        return schemas.Attendee.from_snapshot(attendee.get())
+        ref = self.db.collection('attendees').document()
+        counted = self.upgrade_room(room_id)
+
+        @transactional
+        def create(transaction: Transaction) -> dict:
+            # rebuilt on retry, so the attendee is what the last attempt wrote
+            data = {
+                'name': profile.display_name,
+                'profile_id': profile.id,
+                'room_id': room_id,
+                'created': utc_now(),
+                'hand_up': False,
+                'answering': False,
+                'answers': 0,
+                'room_owner_likes': 0,
+                'peer_likes': 0,
+                # used to pick random attendee with indexed query
+                'random_key': random.random(),
+            }
+            transaction.set(ref, data)
+            self._count(transaction, room_id, counted, attendees=1)
+            return written(data)
+
+        data = create(self.db.transaction())
+        return self._remember('attendees', schemas.Attendee(id=ref.id, **data))
+
+    def backfill_random_keys(self, room_id: str) -> int:
+        """
+        Give random_key to attendees which joined before it existed,
+        written in batches. Return number of updated attendees.
+        """
+        query = self.db.collection('attendees').where('room_id', '==', room_id)
+        missing = [doc for doc in query.stream() if 'random_key' not in doc.to_dict()]
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = self.db.batch()
+            for doc in missing[i:i + BATCH_SIZE]:
+                batch.update(doc.reference, {'random_key': random.random()})
+            batch.commit()
+        return len(missing)
+
+    def room_profile_ids(self, room_id: str) -> set[str]:
+        """
+        Profiles which joined the room, read with a single query.
+        """
+        query = self.db.collection('attendees').where('room_id', '==', room_id)
+        return {doc.to_dict()['profile_id'] for doc in query.stream()}
+
+    def create_attendees(
+        self,
+        room_id: str,
+        profiles: list[schemas.Profile],
+    ) -> list[schemas.Attendee]:
+        """
+        Add attendees with write batches, every batch counts its attendees
+        on the room. Attendees are built from written data, not read back.
+        """
+        room = self.db.collection('rooms').document(room_id)
+        counted = self.upgrade_room(room_id)
+        collection = self.db.collection('attendees')
+        page_size = BATCH_SIZE - 1
+        created = []
+        for i in range(0, len(profiles), page_size):
+            batch = self.db.batch()
+            page = []
+            for profile in profiles[i:i + page_size]:
+                ref = collection.document()
+                data = {
+                    'name': profile.display_name,
+                    'profile_id': profile.id,
+                    'room_id': room_id,
+                    'created': utc_now(),
+                    'hand_up': False,
+                    'answering': False,
+                    'answers': 0,
+                    'room_owner_likes': 0,
+                    'peer_likes': 0,
+                    'random_key': random.random(),
+                }
+                batch.set(ref, data)
+                page.append(schemas.Attendee(id=ref.id, **written(data)))
+            if counted:
+                batch.update(room, {'attendee_count': Increment(len(page))})
+            batch.commit()
+            created.extend(self._remember('attendees', a) for a in page)
+        self._forget('room_counters', room_id)
+        return created
 
     def delete_attendee(self, attendee_id: str) -> None:
-        self.db.collection('attendees').document(attendee_id).delete()
+        try:
+            room_id = self.get_attendee(attendee_id).room_id
+        except NotFound:
+            return
+        self._forget('attendees', attendee_id)
+        counted = self.upgrade_room(room_id)
+        ref = self.db.collection('attendees').document(attendee_id)
+
+        @transactional
+        def delete(transaction: Transaction):
+            doc = next(iter(transaction.get(ref)), None)
+            if doc is None or not doc.exists:
+                return
+            attendee = doc.to_dict()
+            transaction.delete(ref)
+            answering = {'answering_id': None} if attendee.get('answering') else {}
+            self._count(
+                transaction, room_id, counted,
+                attendees=-1, hands_up=-int(bool(attendee.get('hand_up'))),
+                **answering,
+            )
+
+        delete(self.db.transaction())
 
     def get_attendee(self, attendee_id: str) -> schemas.Attendee:
-        doc = self.db.collection('attendees').document(attendee_id).get()
-        if not doc.exists:
-            raise NotFound()
-        return schemas.Attendee.from_snapshot(doc)
+        return self._get('attendees', attendee_id, schemas.Attendee)
 
     def get_currently_answering(self) -> Optional[schemas.Attendee]:
         query = self.db.collection('attendees').where(
@@ -163,43 +542,167 @@ class Crud:
         else:
             return None
 
-    def stop_all_answers(self, room_id: str) -> None:
+    def stop_all_answers(self, room_id: str) -> list[str]:
+        """
+        Return ids of attendees which were answering.
+        """
         query = self.db.collection('attendees').where(
             'room_id', '==', room_id
         ).where(
             'answering', '==', True
         )
-        for doc in query.stream():
-            doc.reference.update(
+
+        counted = self.upgrade_room(room_id)
+
+        @transactional
+        def stop(transaction: Transaction) -> list[str]:
+            docs = list(transaction.get(query))
+            for doc in docs:
+                transaction.update(
+                    doc.reference,
+                    {
+                        'answering': False,
+                        'answers': Increment(1),
+                    }
+                )
+            if docs:
+                self._count(transaction, room_id, counted, answering_id=None)
+            return [doc.id for doc in docs]
+
+        stopped = stop(self.db.transaction())
+        for attendee_id in stopped:
+            self._forget('attendees', attendee_id)
+        return stopped
+
+    def start_answer(self, attendee_id: str):
+        room_id = self.get_attendee(attendee_id).room_id
+        self._forget('attendees', attendee_id)
+        counted = self.upgrade_room(room_id)
+        ref = self.db.collection('attendees').document(attendee_id)
+
+        @transactional
+        def start(transaction: Transaction):
+            doc = next(iter(transaction.get(ref)), None)
+            if doc is None or not doc.exists:
+                raise NotFound()
+            attendee = doc.to_dict()
+            transaction.update(
+                ref,
                 {
-                    'answering': False,
-                    'answers': Increment(1),
+                    'answering': True,
+                    'hand_up': False,
                 }
             )
+            self._count(
+                transaction, room_id, counted,
+                hands_up=-int(bool(attendee.get('hand_up'))),
+                answering_id=attendee_id,
+            )
 
-    def start_answer(self, attendee_id: str):
-        ref = self.db.collection('attendees').document(attendee_id)
-        ref.update(
-            {
+        start(self.db.transaction())
+
+    def advance_queue(
+        self,
+        room_id: str,
+        attendee_id: Optional[str],
+        hand_up: bool = True,
+    ) -> tuple[Optional[schemas.Attendee], list[schemas.Attendee]]:
+        """
+        Stop answers of the room and let the attendee answer in one transaction.
+        With `hand_up` the attendee must still have the hand up,
+        otherwise NoNextAttendee is raised and nothing changes, so
+        concurrent calls never start the same attendee twice.
+        Return the answering attendee and stopped attendees, as written.
+        """
+        answering = self.db.collection('attendees').where(
+            'room_id', '==', room_id
+        ).where(
+            'answering', '==', True
+        )
+        ref = attendee_id and self.db.collection('attendees').document(attendee_id)
+        counted = self.upgrade_room(room_id)
+
+        @transactional
+        def advance(transaction: Transaction) -> tuple:
+            docs = list(transaction.get(answering))
+            data = None
+            if ref:
+                doc = next(iter(transaction.get(ref)), None)
+                if doc is None or not doc.exists:
+                    raise NotFound()
+                data = doc.to_dict()
+                if hand_up and not data.get('hand_up'):
+                    raise NoNextAttendee()
+
+            stopped = []
+            for doc in docs:
+                stop = {
+                    'answering': False,
+                    'answers': Increment(1),
+                }
+                transaction.update(doc.reference, stop)
+                stopped.append(schemas.Attendee(id=doc.id, **written(stop, doc.to_dict())))
+            if data is None:
+                if stopped:
+                    self._count(transaction, room_id, counted, answering_id=None)
+                return None, stopped
+
+            changes = {
                 'answering': True,
                 'hand_up': False,
             }
-        )
+            transaction.update(ref, changes)
+            self._count(
+                transaction, room_id, counted,
+                hands_up=-int(bool(data.get('hand_up'))),
+                answering_id=attendee_id,
+            )
+            # a restarted attendee got both updates,
+            # `changes` is left as given to the transaction
+            applied = dict(changes)
+            if any(a.id == attendee_id for a in stopped):
+                applied['answers'] = Increment(1)
+            attendee = schemas.Attendee(id=attendee_id, **written(applied, data))
+            return attendee, stopped
+
+        attendee, stopped = advance(self.db.transaction())
+        for stopped_attendee in stopped:
+            self._remember('attendees', stopped_attendee)
+        if attendee:
+            self._remember('attendees', attendee)
+        return attendee, stopped
 
     def hand_toggle(self, attendee: schemas.Attendee) -> schemas.Attendee:
         ref = self.db.collection('attendees').document(attendee.id)
-        ref.update(
-            {
-                'hand_up': not attendee.hand_up,
-                'hand_change_timestamp': datetime.now(),
+        hand_up = not attendee.hand_up
+        counted = self.upgrade_room(attendee.room_id)
+
+        @transactional
+        def toggle(transaction: Transaction):
+            doc = next(iter(transaction.get(ref)), None)
+            if doc is None or not doc.exists:
+                raise NotFound()
+            current = doc.to_dict()
+            was_up = bool(current.get('hand_up'))
+            changes = {
+                'hand_up': hand_up,
+                'hand_change_timestamp': utc_now(),
             }
-        )
-        return schemas.Attendee.from_snapshot(ref.get())
+            transaction.update(ref, changes)
+            self._count(
+                transaction, attendee.room_id, counted,
+                hands_up=int(hand_up) - int(was_up),
+            )
+            return written(changes, current)
+
+        data = toggle(self.db.transaction())
+        return self._remember('attendees', schemas.Attendee(id=ref.id, **data))
 
     def attendees_in_queue(
         self,
         room_id: str,
-        limit: int = 100
+        limit: int = 100,
+        records: bool = False,
     ) -> list[schemas.Attendee]:
         query = self.db.collection('attendees')
         query = query.where(
@@ -209,27 +712,27 @@ class Crud:
         ).limit(limit)
         docs = list(query.stream())
 
-        return [schemas.Attendee.from_snapshot(doc) for doc in docs]
+        return [decode_attendee(doc, records) for doc in docs]
 
     def list_notification_tokens(
         self,
         profile_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
     ) -> list[schemas.NotificationToken]:
         query = self.db.collection('notification_tokens')
         query = query.where(
             'profile_id', '==', profile_id
         )
+        query = self._start_after(query, 'notification_tokens', cursor)
+        if limit:
+            query = query.limit(limit)
         docs = list(query.stream())
 
-        return [schemas.NotificationToken.from_snapshot(doc) for doc in docs]
+        return [schemas.NotificationToken.from_snapshot(doc, trusted=True) for doc in docs]
 
     def get_notification_token(self, token: str) -> schemas.NotificationToken:
-        ref = self.db.collection('notification_tokens').document(token)
-        doc = ref.get()
-        if not doc.exists:
-            raise NotFound
-
-        return schemas.NotificationToken.from_snapshot(doc)
+        return self._get('notification_tokens', token, schemas.NotificationToken)
 
     def create_notification_token(
         self,
@@ -237,32 +740,52 @@ class Crud:
         token: str,
     ) -> schemas.NotificationToken:
         ref = self.db.collection('notification_tokens').document(token)
-        ref.set({
+        data = {
             'profile_id': profile.id,
-            'created': datetime.now(),
+            'created': utc_now(),
             'message_count': 0,
             'last_message_timestamp': None,
-        })
-        doc = ref.get()
-        return schemas.NotificationToken.from_snapshot(doc)
+        }
+        ref.set(data)
+        return self._remember(
+            'notification_tokens', schemas.NotificationToken(id=ref.id, **written(data)),
+        )
 
     def update_token_info(self, tokens: list[schemas.NotificationToken]):
-        for token in tokens:
-            ref = self.db.collection('notification_tokens').document(token.id)
-            ref.update({
-                'message_count': Increment(1),
-                'last_message_timestamp': datetime.now()
-            })
+        """
+        Count a sent message for every token, written in batches.
+        """
+        now = utc_now()
+        collection = self.db.collection('notification_tokens')
+        for i in range(0, len(tokens), BATCH_SIZE):
+            batch = self.db.batch()
+            for token in tokens[i:i + BATCH_SIZE]:
+                self._forget('notification_tokens', token.id)
+                batch.update(collection.document(token.id), {
+                    'message_count': Increment(1),
+                    'last_message_timestamp': now,
+                })
+            batch.commit()
 
     def delete_notification_token(self, token: str) -> None:
+        self._forget('notification_tokens', token)
         self.db.collection('notification_tokens').document(token).delete()
 
+    def delete_notification_tokens(self, tokens: list[str]) -> None:
+        collection = self.db.collection('notification_tokens')
+        for i in range(0, len(tokens), BATCH_SIZE):
+            batch = self.db.batch()
+            for token in tokens[i:i + BATCH_SIZE]:
+                self._forget('notification_tokens', token)
+                batch.delete(collection.document(token))
+            batch.commit()
+
 
 class OrderTypes(str, Enum):
     least_answers: str = "least_answers"
-    # first_arrived: str = "first_arrived"
-    # random_in_queue: str = "random_in_queue"
-    # random_in_room: str = "random_in_room"
+    first_arrived: str = "first_arrived"
+    random_in_queue: str = "random_in_queue"
+    random_in_room: str = "random_in_room"
     specific_attendee: str = "specific_attendee"
 
 
@@ -279,43 +802,82 @@ class NextAttendee:
             title='Algorithm used to pick the next attendee.'
         ),
         db: FirestoreDb = Depends(services.firestore_transport),
+        crud: Crud = Depends(),
+        queues: QueueEngine = Depends(services.queue_engine),
+        mirror: MirrorEngine = Depends(services.room_mirror),
     ):
         self.db = db
+        self.crud = crud
+        self.queues = queues
+        self.mirror = mirror
+        self.room_id = room_id
         self.attendee_id = attendee_id
         self.order = order
-        self.query = db.collection('attendees').where(
-            'room_id', '==', room_id
+
+    @property
+    def query(self):
+        return self.db.collection('attendees').where(
+            'room_id', '==', self.room_id
+        )
+
+    def _load_queue(self) -> list[schemas.Attendee]:
+        if (in_queue := self.mirror.in_queue(self.room_id)) is not None:
+            return in_queue
+        return self.crud.attendees_in_queue(
+            self.room_id, QUEUE_LOAD_LIMIT, records=True,
         )
 
-    def next_attendee(self):
+    @property
+    def queue(self) -> RoomQueue:
+        return self.queues.room(self.room_id, self._load_queue)
+
+    @property
+    def needs_hand_up(self) -> bool:
+        """
+        Queue orders only pick attendees with the hand up.
+        """
+        return self.order not in (
+            OrderTypes.random_in_room, OrderTypes.specific_attendee,
+        )
+
+    def next_attendee(self) -> Optional[schemas.Attendee]:
         func = getattr(self, f'_{self.order.name}')
-        doc = func()
-        if not doc:
-            return None
-        return schemas.Attendee.from_snapshot(doc)
+        return func()
 
     def _specific_attendee(self):
-        # reload attendee info
-        ref = self.db.collection('attendees').document(self.attendee_id)
-        doc = ref.get()
-        if not doc.exists:
-            raise NotFound
-        return doc
+        return self.crud.get_attendee(self.attendee_id)
 
     def _least_answers(self):
-        query = self.query.where(
-            'hand_up', '==', True
-        ).order_by(
-            'answers',
-            direction=Query.DESCENDING,
-        ).limit(1)
-        return next(query.stream(), None)
+        return self.queue.peek()
 
     def _first_arrived(self):
-        return None
+        return self.queue.first_arrived()
 
     def _random_in_queue(self):
-        return None
+        return self.queue.random()
 
     def _random_in_room(self):
-        return None
+        """
+        Every attendee gets random_key on creation. First attendee after
+        a random pivot is a random pick which costs a single indexed read,
+        wrap around to the start when pivot is past the last key.
+        Rooms older than random_key get the keys on their first pick.
+        Mirrored rooms are picked from memory.
+        """
+        if (attendees := self.mirror.attendees(self.room_id)) is not None:
+            return random.choice(attendees) if attendees else None
+
+        self.crud.upgrade_room(self.room_id)
+        pivot = random.random()
+        query = self.query.where(
+            'random_key', '>=', pivot
+        ).order_by('random_key').limit(1)
+        doc = next(query.stream(), None)
+        if not doc:
+            query = self.query.where(
+                'random_key', '<', pivot
+            ).order_by('random_key').limit(1)
+            doc = next(query.stream(), None)
+        if not doc:
+            return None
+        return schemas.Attendee.from_snapshot(doc)
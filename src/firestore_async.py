@@ -0,0 +1,189 @@
+import asyncio
+from typing import Optional, List, Union
+from fastapi import Request
+from firebase_admin.auth import UserRecord
+from google.cloud.firestore import AsyncClient as AsyncFirestoreDb
+from google.cloud.firestore import Query
+from starlette.concurrency import run_in_threadpool
+
+import schemas
+import firestore
+from firestore import (
+    NotFound, InvalidCursor, decode_cursor, decode_attendee, utc_now, written,
+    FETCH_CHUNK_SIZE,
+)
+
+
+class AsyncCrud:
+    """
+    Async versions of the firestore.Crud methods used by `async def`
+    endpoints and authentication, running on the async Firestore client,
+    so requests waiting on gRPC don't hold threadpool workers.
+    Only those methods are mirrored, writes of rooms and attendees
+    always go through the transactional firestore.Crud.
+    """
+    def __init__(self, db: AsyncFirestoreDb):
+        self.db = db
+
+    async def get_or_create_profile(
+        self,
+        user_info: UserRecord
+    ) -> schemas.Profile:
+        ref = self.db.collection('profiles').document(user_info.uid)
+        email = user_info.email or ''
+        name_from_email, _ = email.split('@')
+        name_from_email = name_from_email.replace('_', ' ')
+
+        snapshot = await ref.get()
+        if snapshot.exists:
+            return schemas.Profile.from_snapshot(snapshot)
+
+        data = {
+            'display_name': user_info.display_name or name_from_email,
+            'notification_token': None,
+        }
+        await ref.set(data)
+        return schemas.Profile(id=ref.id, **data)
+
+    async def _start_after(self, query, collection: str, cursor: Optional[str]):
+        if not cursor:
+            return query
+        ref = self.db.collection(collection).document(decode_cursor(cursor))
+        doc = await ref.get()
+        if not doc.exists:
+            raise InvalidCursor
+        return query.start_after(doc)
+
+    async def list_rooms(
+        self,
+        profile: Optional[schemas.Profile] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ) -> List[schemas.Room]:
+        query = self.db.collection('rooms').order_by('created')
+        if profile:
+            query = query.where('profile_id', '==', profile.id)
+        query = await self._start_after(query, 'rooms', cursor)
+        if limit:
+            query = query.limit(limit)
+
+        return [schemas.Room.from_snapshot(doc, trusted=True) async for doc in query.stream()]
+
+    async def fetch_rooms(
+        self,
+        ids: List[str],
+        chunk_size: int = FETCH_CHUNK_SIZE,
+    ) -> List[schemas.Room]:
+        ids = list(dict.fromkeys(ids))
+        collection = self.db.collection('rooms')
+
+        async def fetch(chunk: List[str]) -> list:
+            refs = [collection.document(i) for i in chunk]
+            return [doc async for doc in self.db.get_all(refs)]
+
+        chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+        pages = await asyncio.gather(*[fetch(chunk) for chunk in chunks])
+
+        docs = {doc.id: doc for page in pages for doc in page if doc.exists}
+        return [schemas.Room.from_snapshot(docs[i], trusted=True) for i in ids if i in docs]
+
+    async def list_attendees(
+        self,
+        limit: int,
+        room_id: Optional[str] = None,
+        profile_id: Optional[str] = None,
+        descending: bool = True,
+        cursor: Optional[str] = None,
+        records: bool = False,
+    ) -> list[schemas.Attendee]:
+        """
+        With `records` attendees are read-only `schemas.Record`s.
+        """
+        query = self.db.collection('attendees')
+        if room_id:
+            query = query.where(
+                'room_id', '==', room_id
+            )
+        if profile_id:
+            query = query.where(
+                'profile_id', '==', profile_id
+            )
+        query = query.order_by(
+            'created',
+            direction=descending and Query.DESCENDING or Query.ASCENDING,
+        )
+        query = (await self._start_after(query, 'attendees', cursor)).limit(limit)
+
+        return [decode_attendee(doc, records) async for doc in query.stream()]
+
+    async def list_notification_tokens(
+        self,
+        profile_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+    ) -> list[schemas.NotificationToken]:
+        query = self.db.collection('notification_tokens')
+        query = query.where(
+            'profile_id', '==', profile_id
+        )
+        query = await self._start_after(query, 'notification_tokens', cursor)
+        if limit:
+            query = query.limit(limit)
+
+        return [
+            schemas.NotificationToken.from_snapshot(doc, trusted=True)
+            async for doc in query.stream()
+        ]
+
+    async def get_notification_token(self, token: str) -> schemas.NotificationToken:
+        doc = await self.db.collection('notification_tokens').document(token).get()
+        if not doc.exists:
+            raise NotFound
+
+        return schemas.NotificationToken.from_snapshot(doc)
+
+    async def create_notification_token(
+        self,
+        profile: schemas.Profile,
+        token: str,
+    ) -> schemas.NotificationToken:
+        ref = self.db.collection('notification_tokens').document(token)
+        data = {
+            'profile_id': profile.id,
+            'created': utc_now(),
+            'message_count': 0,
+            'last_message_timestamp': None,
+        }
+        await ref.set(data)
+        return schemas.NotificationToken(id=ref.id, **written(data))
+
+    async def delete_notification_token(self, token: str) -> None:
+        await self.db.collection('notification_tokens').document(token).delete()
+
+
+class ThreadedCrud:
+    """
+    Async facade over the blocking firestore.Crud.
+    Used when the app is connected without the async Firestore client:
+    every call still runs in the threadpool, but endpoints can await it.
+    """
+    def __init__(self, crud: firestore.Crud):
+        self.crud = crud
+
+    def __getattr__(self, name: str):
+        method = getattr(self.crud, name)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+        return call
+
+
+async def crud(request: Request) -> Union[AsyncCrud, ThreadedCrud]:
+    """
+    Request dependency, selects data path configured in `services.connect`.
+    A coroutine, so resolving it doesn't take a threadpool worker.
+    """
+    db = request.app.firestore_async_transport
+    if db is None:
+        return ThreadedCrud(firestore.Crud(request.app.firestore_transport))
+    return AsyncCrud(db)
@@ -1,36 +1,48 @@
+import logging
 from fastapi import Depends
-from firebase_admin import messaging as messaging_transport
 
 import firestore
 import services
 import schemas
+from dispatch import PushThrottle, dead_tokens
+
+logger = logging.getLogger(__name__)
 
 
 class Message:
     def __init__(
         self,
         crud: firestore.Crud = Depends(),
-        transport: messaging_transport = Depends(services.messaging_transport)
+        throttle: PushThrottle = Depends(services.push_throttle),
     ):
         self.crud = crud
-        self.transport = transport
+        # every push goes through the throttle, which queues it on the dispatcher
+        self.throttle = throttle
 
-    def send(
-        self,
-        tokens: list[schemas.NotificationToken],
-        data: dict
-    ):
-        message = self.transport.MulticastMessage(
-            data=data,
-            tokens=[t.id for t in tokens],
-        )
-        response = self.transport.send_multicast(message)
+    def _sent(self, tokens: list[schemas.NotificationToken], response):
+        """
+        Runs in a dispatcher thread, so it doesn't share request's Crud.
+        Tokens of uninstalled apps are deleted, the rest are counted.
+        """
+        crud = firestore.Crud(self.crud.db)
         if response.success_count < len(tokens):
-            # TODO: handle not delivered messages
-            #raise RuntimeError
-            pass
+            if dead := dead_tokens(tokens, response):
+                logger.info(f"Deleting {len(dead)} dead notification tokens.")
+                dead_ids = {t.id for t in dead}
+                crud.delete_notification_tokens(list(dead_ids))
+                tokens = [t for t in tokens if t.id not in dead_ids]
+
+        crud.update_token_info(tokens)
 
-        self.crud.update_token_info(tokens)
+    @staticmethod
+    def hand_up_data(names: list[str]) -> dict:
+        """
+        Push data for hand ups collected while instructor's device was throttled.
+        """
+        data = {'hand_up': ', '.join(dict.fromkeys(names))}
+        if len(names) > 1:
+            data['hand_up_count'] = str(len(names))
+        return data
 
     def maybe_notify_instructor(
         self,
@@ -40,8 +52,12 @@ class Message:
             # Not raising hand
             return False
 
-        in_queue = self.crud.attendees_in_queue(attendee.room_id, limit=2)
-        if len(in_queue) >= 2:
+        counters = self.crud.get_room_counters(attendee.room_id)
+        in_queue = counters.hand_up_count
+        if in_queue is None:
+            # room wasn't counted yet
+            in_queue = len(self.crud.attendees_in_queue(attendee.room_id, limit=2))
+        if in_queue >= 2:
             # at least 2 attendees in queue
             return False
 
@@ -51,6 +67,7 @@ class Message:
             # Profile has no associated notification tokens
             return False
 
-        # TODO: filter out tokens that we used recently (less then 5 seconds)
-        self.send(tokens, {'hand_up': attendee.name})
-        return True
+        # tokens used recently get a summary when their window ends
+        return self.throttle.notify(
+            tokens, attendee.name, self.hand_up_data, on_sent=self._sent,
+        )
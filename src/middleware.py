@@ -1,13 +1,50 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from fastapi import Request
+from typing import Callable, Optional
 
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-class CacheControlHeader(BaseHTTPMiddleware):
-    def __init__(self, app, header_value='no-store'):
-        super().__init__(app)
-        self.header_value = header_value
 
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        response.headers["Cache-Control"] = self.header_value
-        return response
+def cache_control(header_value: str) -> Callable:
+    """
+    Endpoint decorator, overrides the default Cache-Control policy
+    of `CacheControlHeader` for successful responses of the route.
+    Put it below the route decorator.
+    """
+    def decorate(endpoint: Callable) -> Callable:
+        endpoint.cache_control = header_value
+        return endpoint
+    return decorate
+
+
+class CacheControlHeader:
+    """
+    Pure ASGI middleware, adds Cache-Control header to http responses
+    while they start, so response bodies pass through untouched.
+    Responses which set the header themselves keep it.
+    """
+    def __init__(self, app: ASGIApp, header_value: str = 'no-store'):
+        self.app = app
+        self.header_value = header_value.encode('latin-1')
+
+    def _policy(self, scope: Scope, status: int) -> bytes:
+        # router puts the matched endpoint into the shared scope
+        policy: Optional[str] = getattr(scope.get('endpoint'), 'cache_control', None)
+        if policy is None or status >= 400:
+            return self.header_value
+        return policy.encode('latin-1')
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_header(message: Message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', ()))
+                if not any(key.lower() == b'cache-control' for key, _ in headers):
+                    headers.append(
+                        (b'cache-control', self._policy(scope, message['status']))
+                    )
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_header)
@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from google.cloud.firestore import Client as FirestoreDb
+from google.cloud.firestore_v1.watch import ChangeType
+
+import schemas
+from queues import QueueEngine
+
+
+class RoomMirror:
+    """
+    Attendees of a single room as last seen by its Firestore watch.
+    """
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.watch = None
+        self._attendees: dict[str, schemas.Record] = {}
+
+    def attendees(self) -> list[schemas.Record]:
+        """
+        In creation order, like attendee list queries.
+        """
+        with self.lock:
+            # the watch and local writes both have aware utc datetimes
+            return sorted(self._attendees.values(), key=lambda a: a.created)
+
+    def put(self, attendee: schemas.Record) -> None:
+        with self.lock:
+            self._attendees[attendee.id] = attendee
+
+    def discard(self, attendee_id: str) -> None:
+        with self.lock:
+            self._attendees.pop(attendee_id, None)
+
+
+class MirrorEngine:
+    """
+    Optional in-memory mirror of attendees of recently used rooms.
+    Every mirrored room has an `on_snapshot` watch which keeps it current,
+    changes are passed on to the queue engine, so syncs of active rooms
+    don't query Firestore. Least recently used rooms over `max_rooms`
+    are unsubscribed. A room reads as None until its first snapshot,
+    callers fall back to Firestore queries then.
+    """
+    def __init__(
+        self,
+        db: FirestoreDb,
+        queues: QueueEngine,
+        enabled: bool = False,
+        max_rooms: int = 100,
+    ):
+        self.db = db
+        self.queues = queues
+        self.enabled = enabled
+        self.max_rooms = max_rooms
+        self._rooms: OrderedDict[str, RoomMirror] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def attendees(self, room_id: str) -> Optional[list[schemas.Record]]:
+        """
+        All attendees of the room, starts watching the room on first use.
+        """
+        if not self.enabled:
+            return None
+
+        evicted = []
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is not None and room.ready.is_set() and not room.watch.is_active:
+                # watch closed after an error, start over
+                del self._rooms[room_id]
+                room = None
+            if room is None:
+                room = self._rooms[room_id] = RoomMirror(room_id)
+                room.watch = self.db.collection('attendees').where(
+                    'room_id', '==', room_id
+                ).on_snapshot(
+                    lambda docs, changes, read_time: self._changed(room, changes)
+                )
+                while len(self._rooms) > self.max_rooms:
+                    evicted.append(self._rooms.popitem(last=False)[1])
+            self._rooms.move_to_end(room_id)
+
+        for old in evicted:
+            old.watch.unsubscribe()
+        if not room.ready.is_set():
+            return None
+        return room.attendees()
+
+    def in_queue(self, room_id: str) -> Optional[list[schemas.Record]]:
+        if (attendees := self.attendees(room_id)) is None:
+            return None
+        return [a for a in attendees if a.hand_up]
+
+    def _changed(self, room: RoomMirror, changes: list) -> None:
+        """
+        Watch callback, runs in the watch thread.
+        """
+        for change in changes:
+            if change.type == ChangeType.REMOVED:
+                room.discard(change.document.id)
+                self.queues.remove(room.room_id, change.document.id)
+                continue
+            attendee = schemas.Attendee.record_from_snapshot(change.document)
+            room.put(attendee)
+            self.queues.update(attendee)
+        room.ready.set()
+
+    def _mirrored(self, room_id: str) -> Optional[RoomMirror]:
+        with self._lock:
+            return self._rooms.get(room_id)
+
+    def apply(self, attendee: schemas.Attendee) -> None:
+        """
+        Attendee written by this process, shown before the watch delivers it.
+        """
+        if (room := self._mirrored(attendee.room_id)) is not None:
+            if isinstance(attendee, schemas.FirebaseModel):
+                attendee = schemas.Attendee.record_type()(attendee.__dict__)
+            room.put(attendee)
+
+    def discard(self, room_id: str, attendee_id: str) -> None:
+        if (room := self._mirrored(room_id)) is not None:
+            room.discard(attendee_id)
+
+    def forget(self, room_id: str) -> None:
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+        if room is not None:
+            room.watch.unsubscribe()
+
+    def close(self) -> None:
+        with self._lock:
+            rooms, self._rooms = list(self._rooms.values()), OrderedDict()
+        for room in rooms:
+            room.watch.unsubscribe()
@@ -0,0 +1,162 @@
+import random
+import threading
+from collections import OrderedDict
+from itertools import count
+from heapq import heappush, heappop, heapify
+from time import time
+from typing import Callable, Optional, Iterable
+
+import schemas
+
+
+class RoomQueue:
+    """
+    Attendees with raised hands in a single room, kept in a binary heap.
+    Heap order matches NextAttendee least_answers query: by answers, then by
+    the time the hand went up. Other pick orders scan the entries in memory.
+    Removed attendees are only marked dead and dropped from the heap top
+    lazily, so every operation is O(log n).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded_at = 0.0
+        # entries are [key, sequence, attendee, alive], sequence keeps a dead
+        # and a live entry of the same attendee from comparing attendees
+        self._heap: list[list] = []
+        self._entries: dict[str, list] = {}
+        self._sequence = count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, attendee_id: str) -> bool:
+        return attendee_id in self._entries
+
+    @staticmethod
+    def _key(attendee: schemas.Attendee) -> tuple:
+        raised = attendee.hand_change_timestamp
+        return (
+            -attendee.answers,
+            raised.timestamp() if raised else 0.0,
+            attendee.id,
+        )
+
+    def reset(self, attendees: Iterable[schemas.Attendee]) -> None:
+        with self.lock:
+            self._entries = {
+                a.id: [self._key(a), next(self._sequence), a, True]
+                for a in attendees if a.hand_up
+            }
+            self._heap = list(self._entries.values())
+            heapify(self._heap)
+            self.loaded_at = time()
+
+    def push(self, attendee: schemas.Attendee) -> None:
+        with self.lock:
+            self.remove(attendee.id)
+            entry = [self._key(attendee), next(self._sequence), attendee, True]
+            self._entries[attendee.id] = entry
+            heappush(self._heap, entry)
+
+    def remove(self, attendee_id: str) -> Optional[schemas.Attendee]:
+        with self.lock:
+            entry = self._entries.pop(attendee_id, None)
+            if not entry:
+                return None
+            entry[3] = False
+            if len(self._heap) > 2 * len(self._entries) + 32:
+                # too many dead entries, rebuild
+                self._heap = list(self._entries.values())
+                heapify(self._heap)
+            return entry[2]
+
+    def peek(self) -> Optional[schemas.Attendee]:
+        with self.lock:
+            while self._heap and not self._heap[0][3]:
+                heappop(self._heap)
+            return self._heap[0][2] if self._heap else None
+
+    def first_arrived(self) -> Optional[schemas.Attendee]:
+        with self.lock:
+            entry = min(self._entries.values(), key=lambda e: e[0][1:], default=None)
+            return entry and entry[2]
+
+    def random(self) -> Optional[schemas.Attendee]:
+        with self.lock:
+            if not self._entries:
+                return None
+            return random.choice(list(self._entries.values()))[2]
+
+    def attendees(self) -> list[schemas.Attendee]:
+        """
+        All attendees in queue order.
+        """
+        with self.lock:
+            return [entry[2] for entry in sorted(self._entries.values())]
+
+
+class QueueEngine:
+    """
+    Per-process queues of all recently used rooms.
+    Endpoints keep queues current after every hand change, queues are
+    reloaded from Firestore when older than `reconcile_interval` seconds
+    to pick up changes made by other processes.
+    """
+    def __init__(self, reconcile_interval: float = 10, max_rooms: int = 1000):
+        self.reconcile_interval = reconcile_interval
+        self.max_rooms = max_rooms
+        self._rooms: OrderedDict[str, RoomQueue] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def room(
+        self,
+        room_id: str,
+        loader: Callable[[], list[schemas.Attendee]],
+    ) -> RoomQueue:
+        with self._lock:
+            queue = self._rooms.get(room_id)
+            if queue is None:
+                queue = self._rooms[room_id] = RoomQueue()
+                if len(self._rooms) > self.max_rooms:
+                    self._rooms.popitem(last=False)
+            self._rooms.move_to_end(room_id)
+
+        with queue.lock:
+            if time() - queue.loaded_at > self.reconcile_interval:
+                queue.reset(loader())
+        return queue
+
+    def _loaded(self, room_id: str) -> Optional[RoomQueue]:
+        with self._lock:
+            return self._rooms.get(room_id)
+
+    def update(self, attendee: schemas.Attendee) -> None:
+        """
+        Put attendee in queue or take it out depending on the hand.
+        Rooms which are not loaded yet are skipped,
+        they will be read from Firestore on first use.
+        """
+        if (queue := self._loaded(attendee.room_id)) is not None:
+            if attendee.hand_up:
+                queue.push(attendee)
+            else:
+                queue.remove(attendee.id)
+
+    def remove(self, room_id: str, attendee_id: str) -> None:
+        if (queue := self._loaded(room_id)) is not None:
+            queue.remove(attendee_id)
+
+    def answered(self, room_id: str, attendee_ids: list[str]) -> None:
+        """
+        Answer counter went up for attendees, move them in the queue if needed.
+        """
+        if (queue := self._loaded(room_id)) is None:
+            return
+        with queue.lock:
+            for attendee_id in attendee_ids:
+                if attendee := queue.remove(attendee_id):
+                    queue.push(attendee.copy(update={'answers': attendee.answers + 1}))
+
+    def forget(self, room_id: str) -> None:
+        with self._lock:
+            self._rooms.pop(room_id, None)
@@ -1,95 +1,362 @@
+import hashlib
+import json
+import uuid
+from contextlib import contextmanager
 from fastapi import Depends
-from typing import Optional
-from json import loads
+from typing import Optional, Any, Callable, Union
 from firebase_admin import db as realtime_db
 
 import firestore
+import mirror
+from debounce import Debouncer
+import queues
 import schemas
 import services
+from cache import KeyedLocks, SnapshotCache, TTLCache
+
+
+# room nodes keyed by attendee id, written as per-attendee changes
+KEYED_NODES = ('attendees', 'queue')
+# room node with the version of every keyed node, see Crud._send
+VERSIONS = 'versions'
+
+
+class Keyed:
+    """
+    Lazily computed node with children keyed by id. When the process knows
+    what it wrote last time and the database still holds that version,
+    only changed children are sent.
+    """
+    def __init__(self, items: Callable[[], dict[str, Any]]):
+        self.items = items
 
 
 class Crud:
     realtime: realtime_db
     db_crud: firestore.Crud
+    queues: queues.QueueEngine
 
     def __init__(
         self,
         db_crud: firestore.Crud = Depends(),
         realtime: realtime_db = Depends(services.realtime_db_transport),
+        queue_engine: queues.QueueEngine = Depends(services.queue_engine),
+        snapshots: TTLCache = Depends(services.realtime_snapshots),
+        rooms: SnapshotCache = Depends(services.realtime_rooms),
+        room_mirror: mirror.MirrorEngine = Depends(services.room_mirror),
+        publisher: Debouncer = Depends(services.realtime_publisher),
+        locks: KeyedLocks = Depends(services.realtime_locks),
     ):
         self.db_crud = db_crud
         self.realtime = realtime
+        self.queues = queue_engine
+        # room id -> {node: (version, items)} as last written,
+        # shared by all requests of the process
+        self.snapshots = snapshots
+        # room id -> (etag, RealtimeRoom) as last read, shared by all requests of the process
+        self.rooms = rooms
+        self.mirror = room_mirror
+        self.publisher = publisher
+        # room id -> lock, shared by all requests of the process
+        self.locks = locks
+        # path -> value (or callable producing it) collected by `batch`
+        self._pending: Optional[dict[str, Union[Any, Callable[[], Any]]]] = None
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect every write made inside the block and send them
+        as a single multi-path update when the block exits.
+        Nested blocks join the outer one.
+        """
+        if self._pending is not None:
+            yield
+            return
+
+        self._pending = {}
+        try:
+            yield
+            pending = self._pending
+        finally:
+            self._pending = None
+        self._flush(pending)
+
+    def _write(self, path: str, value: Union[Any, Callable[[], Any]]):
+        """
+        Replace value at path, None deletes it.
+        Callables are evaluated right before writing, so in a batch
+        only the last write to a path does any work.
+        """
+        if self._pending is None:
+            self._flush({path: value})
+            return
+
+        # later write replaces everything below the path
+        for pending_path in list(self._pending):
+            if pending_path.startswith(path + '/'):
+                del self._pending[pending_path]
+        self._pending.pop(path, None)
+        self._pending[path] = value
+
+    @staticmethod
+    def _room_ids(paths) -> Optional[set[str]]:
+        """
+        Rooms written by paths, None when all of them are.
+        """
+        room_ids = set()
+        for path in paths:
+            keys = path.split('/')
+            if keys[0] == 'rooms':
+                if len(keys) == 1:
+                    return None
+                room_ids.add(keys[1])
+        return room_ids
+
+    def _flush(self, pending: dict[str, Union[Any, Callable[[], Any]]]):
+        """
+        Syncs of a room run one at a time, from computing the values
+        to storing the snapshot, so the snapshot stored last always
+        describes what the database holds.
+        """
+        with self.locks.hold(self._room_ids(pending)):
+            self._send(pending)
+
+    def _stored_versions(self, room_id: str) -> dict:
+        return self.realtime.reference(f'rooms/{room_id}/{VERSIONS}').get() or {}
+
+    def _send(self, pending: dict[str, Union[Any, Callable[[], Any]]]):
+        """
+        Every process can write a room, so a snapshot is only trusted while
+        the database holds its version. Each keyed write stores a new version
+        in the same update, a full write replaces the versions of the node,
+        a diff swaps its own. A diff racing another process leaves two
+        versions behind, so the next write of any process sends everything.
+        """
+        values = {}
+        snapshots = []
+        # room id -> versions read from the database
+        stored = {}
+        # parents first, so a rewritten room forgets its snapshot before children remember theirs
+        for path in sorted(pending, key=lambda p: p.count('/')):
+            value = pending[path]
+            if not isinstance(value, Keyed):
+                values[path] = value() if callable(value) else value
+                self._forget(path)
+                continue
+
+            _, room_id, node = path.split('/')
+            new = value.items()
+            versions = f'rooms/{room_id}/{VERSIONS}/{node}'
+            rewritten = any(path.startswith(p + '/') for p in pending)
+            old_version, old = self.snapshots.get(room_id, {}).get(node, (None, None))
+            if old is not None and not rewritten:
+                if room_id not in stored:
+                    stored[room_id] = self._stored_versions(room_id)
+                if stored[room_id].get(node) != {old_version: True}:
+                    old = None
+            if old is None or rewritten:
+                # unknown, written by another process or rewritten
+                # along with the parent, send everything
+                version = uuid.uuid4().hex
+                values[path] = new or None
+                values[versions] = {version: True}
+                snapshots.append((room_id, node, version, new))
+                continue
+
+            changes = {f'{path}/{key}': None for key in old.keys() - new.keys()}
+            for key, item in new.items():
+                if old.get(key) != item:
+                    changes[f'{path}/{key}'] = item
+            if changes:
+                version = uuid.uuid4().hex
+                values.update(changes)
+                values[f'{versions}/{old_version}'] = None
+                values[f'{versions}/{version}'] = True
+                snapshots.append((room_id, node, version, new))
+
+        update = {}
+        # Realtime db rejects updates where one path is inside another,
+        # so nested writes are merged into the parent value.
+        for path in sorted(values, key=lambda p: p.count('/')):
+            value = values[path]
+            parent = next((p for p in update if path.startswith(p + '/')), None)
+            if parent is None:
+                update[path] = value
+                continue
+            if not isinstance(update[parent], dict):
+                update[parent] = {}
+            node = update[parent]
+            *keys, last = path[len(parent) + 1:].split('/')
+            for key in keys:
+                if not isinstance(node.get(key), dict):
+                    node[key] = {}
+                node = node[key]
+            node[last] = value
+
+        try:
+            if len(update) == 1:
+                [(path, value)] = update.items()
+                ref = self.realtime.reference(path)
+                if value is None:
+                    ref.delete()
+                else:
+                    ref.set(value)
+            elif update:
+                self.realtime.reference('/').update(update)
+        finally:
+            # after the write, so rooms read before it aren't cached
+            for path in pending:
+                self._forget_room(path)
+
+        # remember what clients see only after the write went through
+        for room_id, node, version, items in snapshots:
+            room = dict(self.snapshots.get(room_id, {}))
+            room[node] = (version, items)
+            self.snapshots.set(room_id, room)
+
+    def _forget(self, path: str):
+        """
+        Drop snapshots of keyed nodes under the path, they were rewritten.
+        """
+        keys = path.split('/')
+        if keys[0] != 'rooms':
+            return
+        if len(keys) == 1:
+            self.snapshots.clear()
+        elif len(keys) == 2:
+            self.snapshots.invalidate(keys[1])
+        elif keys[2] in KEYED_NODES and (room := self.snapshots.get(keys[1])):
+            room = dict(room)
+            room.pop(keys[2], None)
+            self.snapshots.set(keys[1], room)
+
+    def _forget_room(self, path: str):
+        """
+        Drop cached rooms under the path.
+        """
+        keys = path.split('/')
+        if keys[0] != 'rooms':
+            return
+        if len(keys) == 1:
+            self.rooms.clear()
+        else:
+            self.rooms.invalidate(keys[1])
 
     def _get_attendees(self, room_id: str):
+        if (attendees := self.mirror.attendees(room_id)) is not None:
+            return attendees[:200]
         return self.db_crud.list_attendees(
-            limit=200, room_id=room_id, descending=False,
+            limit=200, room_id=room_id, descending=False, records=True,
         )
 
-    def _get_in_queue(self, room_id):
+    def _load_queue(self, room_id: str):
+        if (in_queue := self.mirror.in_queue(room_id)) is not None:
+            return in_queue
         return self.db_crud.attendees_in_queue(
-            limit=200, room_id=room_id,
+            room_id, firestore.QUEUE_LOAD_LIMIT, records=True,
         )
 
+    def _get_in_queue(self, room_id):
+        queue = self.queues.room(room_id, lambda: self._load_queue(room_id))
+        return queue.attendees()[:200]
+
     @staticmethod
     def _to_dict(model: schemas.BaseModel) -> dict:
         """
-        Schema models know how to convert to json special fields.
-        Convert to json and back from it so we can pass data to the client
-        which is not aware of special data fields.
+        Convert special fields to plain json types, so we can pass data
+        to the client which is not aware of special data fields.
         """
-        return loads(model.json())
+        return schemas.jsonable(model)
 
-    def _parse(self, items: list[schemas.BaseModel]) -> list[dict]:
+    def _parse(self, items: list[schemas.Attendee]) -> dict[str, dict]:
         """
-        Schema models know how to convert to json special fields.
-        Convert to json and back from it so we can pass data to the client
-        which is not aware of special data fields.
+        Convert special fields to plain json types, so we can pass data
+        to the client which is not aware of special data fields.
+        Keyed by id, so a single attendee can be updated in place.
         """
-        return [self._to_dict(i) for i in items]
+        return {i.id: self._to_dict(i) for i in items}
 
-    def delete_room(self, room_id: str):
-        ref = self.realtime.reference(f'rooms/{room_id}')
-        ref.delete()
+    def delete_room(self, room_id: str) -> int:
+        """
+        Delete room with attendees from Firestore and its realtime subtree.
+        Return number of deleted Firestore documents.
+        """
+        deleted = self.db_crud.delete_room(room_id)
+        self._write(f'rooms/{room_id}', None)
+        return deleted
 
     def set_room_attendees(self, room: schemas.Room):
-        ref = self.realtime.reference(f'rooms/{room.id}/attendees')
-        attendees = self._get_attendees(room.id)
-        attendees = self._parse(attendees)
-        if attendees:
-            ref.set(attendees)
+        self._write(
+            f'rooms/{room.id}/attendees',
+            Keyed(lambda: self._parse(self._get_attendees(room.id))),
+        )
 
     def set_room_queue(self, room: schemas.Room):
-        ref = self.realtime.reference(f'rooms/{room.id}/queue')
-        attendees = self._get_in_queue(room.id)
-        attendees = self._parse(attendees)
-        if attendees:
-            ref.set(attendees)
+        self._write(
+            f'rooms/{room.id}/queue',
+            Keyed(lambda: self._parse(self._get_in_queue(room.id))),
+        )
+
+    def _detached(self) -> 'Crud':
+        """
+        Crud for writes made after the request, shares no request state.
+        """
+        return Crud(
+            firestore.Crud(self.db_crud.db), self.realtime, self.queues,
+            self.snapshots, self.rooms, self.mirror, self.publisher, self.locks,
+        )
+
+    def publish_room_queue(self, room: schemas.Room):
+        """
+        Debounced `set_room_queue`, a burst of calls for the room
+        writes the queue once, as it is when the burst settles.
+        """
+        self.publisher.call(
+            (room.id, 'queue'), lambda: self._detached().set_room_queue(room),
+        )
 
     def set_room(self, room: schemas.Room) -> schemas.RealtimeRoom:
-        ref = self.realtime.reference('rooms')
-        ref.update({
-            room.id:
+        with self.batch():
+            self._write(
+                f'rooms/{room.id}',
                 {
                     'profile_id': room.profile_id,
                     'name': room.name,
                 }
-        })
-        self.set_room_attendees(room)
-        self.set_room_queue(room)
+            )
+            self.set_room_attendees(room)
+            self.set_room_queue(room)
 
         return self.get_room(room)
 
     def get_room(self, room: schemas.Room) -> schemas.RealtimeRoom:
-        ref = self.realtime.reference(f'rooms/{room.id}')
-        return schemas.RealtimeRoom.parse_obj(ref.get())
+        _, realtime_room = self.get_room_version(room)
+        return realtime_room
+
+    def get_room_version(self, room: schemas.Room) -> tuple[str, schemas.RealtimeRoom]:
+        """
+        Room as clients see it with its ETag, read through the process cache.
+        The ETag is a digest of the content, so every process agrees on it.
+        """
+        cached = self.rooms.get(room.id)
+        if cached is not None:
+            return cached
+
+        started = self.rooms.started()
+        value = self.realtime.reference(f'rooms/{room.id}').get()
+        digest = hashlib.sha1(
+            json.dumps(value, sort_keys=True, default=str).encode(),
+        ).hexdigest()
+        cached = (f'"{digest}"', schemas.RealtimeRoom.parse_obj(value))
+        self.rooms.set(room.id, cached, started)
+        return cached
 
     def set_answering(
         self,
         room: schemas.Room,
         attendee: Optional[schemas.Attendee] = None,
     ):
-        ref = self.realtime.reference(f'rooms/{room.id}/answering')
-        if not attendee:
-            ref.delete()
-        else:
-            ref.update(self._to_dict(attendee))
+        self._write(
+            f'rooms/{room.id}/answering',
+            attendee and self._to_dict(attendee),
+        )
@@ -1,21 +1,108 @@
+from enum import Enum
 from pydantic import BaseModel, Field
-from typing import Optional
-from datetime import datetime
+from pydantic.json import pydantic_encoder
+from typing import Optional, Any
+from datetime import datetime, date, time
 from google.cloud.firestore import DocumentSnapshot
 
+_PLAIN_TYPES = (str, int, float, bool, type(None))
+_PLAIN_TYPE_SET = frozenset(_PLAIN_TYPES)
+
+
+def jsonable(value: Any) -> Any:
+    """
+    Convert models into plain json types in a single pass.
+    Output is the same as `json.loads(model.json())`
+    without encoding and parsing the json string.
+    """
+    if type(value) in _PLAIN_TYPE_SET:
+        return value
+    if isinstance(value, BaseModel):
+        return {
+            k: v if type(v) in _PLAIN_TYPE_SET else jsonable(v)
+            for k, v in value.__dict__.items()
+        }
+    if isinstance(value, Record):
+        return {
+            k: v if type(v) in _PLAIN_TYPE_SET else jsonable(v)
+            for k, v in zip(value._fields, value._values())
+        }
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, _PLAIN_TYPES):
+        return value
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [jsonable(v) for v in value]
+    return jsonable(pydantic_encoder(value))
+
 
 class PaginationContainer(BaseModel):
     """
-    TODO: figure out pagination:
-    https://firebase.google.com/docs/firestore/query-data/query-cursors
+    Pass cursor back with the same query to get the next page.
+    Cursor is null when there are no more results.
     """
     result: list
-    cursor: str = 'not-implemented'
+    cursor: Optional[str] = None
+
+
+class Record:
+    """
+    Read-only model data without validation and pydantic machinery,
+    for hot paths which only read fields.
+    Every FirebaseModel has its own record type, see `record_type`.
+    """
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+    model: type = None
+
+    def __init__(self, values: dict):
+        for name in self._fields:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is read-only')
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{k}={v!r}' for k, v in zip(self._fields, self._values()))
+        return f'{type(self).__name__}({fields})'
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def dict(self) -> dict:
+        return dict(zip(self._fields, self._values()))
+
+    def copy(self, update: Optional[dict] = None) -> 'Record':
+        values = self.dict()
+        values.update(update or {})
+        return type(self)(values)
+
+    def to_model(self) -> 'FirebaseModel':
+        return self.model.construct(**self.dict())
+
+
+# model class -> ((field name, default), ...), built on first decode
+_field_plans: dict[type, tuple[tuple[str, Any], ...]] = {}
+_record_types: dict[type, type] = {}
+_REQUIRED = object()
 
 
 class FirebaseModel(BaseModel):
     @classmethod
-    def from_snapshot(cls, doc: DocumentSnapshot):
+    def from_snapshot(cls, doc: DocumentSnapshot, trusted: bool = False):
+        """
+        Documents written by this app are `trusted`, they skip validation.
+        """
+        if trusted and (data := cls._decode(doc)) is not None:
+            return cls.construct(_fields_set=set(data), **data)
+
         data = {'id': doc.id}
         for key, value in doc.to_dict().items():
             if hasattr(value, 'id'):
@@ -23,6 +110,51 @@ class FirebaseModel(BaseModel):
             data[key] = value
         return cls(**data)
 
+    @classmethod
+    def record_from_snapshot(cls, doc: DocumentSnapshot) -> Record:
+        """
+        Trusted read-only decode, falls back to validation for incomplete documents.
+        """
+        data = cls._decode(doc)
+        if data is None:
+            data = cls.from_snapshot(doc).__dict__
+        return cls.record_type()(data)
+
+    @classmethod
+    def record_type(cls) -> type:
+        if (record := _record_types.get(cls)) is None:
+            fields = tuple(cls.__fields__)
+            record = _record_types[cls] = type(
+                f'{cls.__name__}Record',
+                (Record,),
+                {'__slots__': fields, '_fields': fields, 'model': cls},
+            )
+        return record
+
+    @classmethod
+    def _field_plan(cls) -> tuple[tuple[str, Any], ...]:
+        if (plan := _field_plans.get(cls)) is None:
+            plan = _field_plans[cls] = tuple(
+                (name, _REQUIRED if field.required else field.default)
+                for name, field in cls.__fields__.items()
+            )
+        return plan
+
+    @classmethod
+    def _decode(cls, doc: DocumentSnapshot) -> Optional[dict]:
+        """
+        Field values without validation, None if a required field is missing.
+        """
+        raw = doc.to_dict()
+        raw['id'] = doc.id
+        data = {}
+        for name, default in cls._field_plan():
+            value = raw.get(name, default)
+            if value is _REQUIRED:
+                return None
+            data[name] = value
+        return data
+
 
 class RoomBase(FirebaseModel):
     name: str = Field(
@@ -42,6 +174,17 @@ class Room(RoomBase):
     created: datetime
 
 
+class RoomCounters(FirebaseModel):
+    """
+    Counters kept on the room document by attendee writes.
+    None for rooms which were not counted yet.
+    """
+    id: str
+    attendee_count: Optional[int] = None
+    hand_up_count: Optional[int] = None
+    answering_id: Optional[str] = None
+
+
 class ProfileBase(FirebaseModel):
     notification_token: Optional[str] = Field(
         ...,
@@ -73,6 +216,23 @@ class Attendee(FirebaseModel):
     peer_likes: int = 0
 
 
+class AttendeeImport(FirebaseModel):
+    profile_ids: list[str] = Field(
+        ...,
+        min_items=1,
+        max_items=1000,
+        example=['student_one', 'student_two'],
+    )
+
+
+class AttendeeImportResult(BaseModel):
+    created: list[Attendee]
+    # profiles which joined the room before
+    existing: list[str]
+    # profiles which don't exist
+    missing: list[str]
+
+
 class HandToggle(FirebaseModel):
     hand_up: bool = Field(..., example=True)
 
@@ -92,6 +252,7 @@ class NotificationToken(FirebaseModel):
 class RealtimeRoom(BaseModel):
     profile_id: str
     name: str
-    attendees: Optional[list[Attendee]] = None
-    queue: Optional[list[Attendee]] = None
+    # keyed by attendee id
+    attendees: Optional[dict[str, Attendee]] = None
+    queue: Optional[dict[str, Attendee]] = None
     answering: Optional[Attendee] = None
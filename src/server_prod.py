@@ -1,14 +1,28 @@
-from uvicorn import Config, Server
-import factory
+import uvicorn
 
+import config
 
-if __name__ == '__main__':
-    server = Server(
-        Config(
-            factory.prod_app(),
-            host="0.0.0.0",
-            port=8080,
-            log_level='info',
-        ),
+
+def run(settings: config.Settings):
+    """
+    Serve the app with `settings.server_workers` processes, one by default.
+    Per-process engines assume a single writer, see config.Settings.
+    Workers import the app factory by name and build their own app,
+    firebase clients are created in the worker, never before the fork.
+    """
+    uvicorn.run(
+        'factory:prod_app',
+        factory=True,
+        host=settings.host,
+        port=settings.port,
+        workers=settings.server_workers,
+        loop=settings.server_loop,
+        http=settings.server_http,
+        timeout_keep_alive=settings.server_keep_alive,
+        backlog=settings.server_backlog,
+        log_level=settings.server_log_level,
     )
-    server.run()
+
+
+if __name__ == '__main__':
+    run(config.get_settings())
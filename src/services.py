@@ -1,37 +1,152 @@
+import firebase_admin
 from fastapi import Request, FastAPI
 from firebase_admin import auth, firestore, messaging, db
+from google.cloud.firestore import AsyncClient
 import config
+from cache import KeyedLocks, SnapshotCache, TTLCache
+from debounce import Debouncer
+from dispatch import PushDispatcher, PushThrottle
+from mirror import MirrorEngine
+from queues import QueueEngine
 
 
-def messaging_transport(request: Request):
+async def messaging_transport(request: Request):
     return request.app.messaging_transport
 
 
-def auth_transport(request: Request):
+async def auth_transport(request: Request):
     return request.app.auth_transport
 
 
-def firestore_transport(request: Request):
+async def firestore_transport(request: Request):
     return request.app.firestore_transport
 
 
-def realtime_db_transport(request: Request):
+async def firestore_async_transport(request: Request):
+    return request.app.firestore_async_transport
+
+
+async def realtime_db_transport(request: Request):
     return request.app.realtime_db_transport
 
 
-def settings(request: Request):
+async def token_cache(request: Request) -> TTLCache:
+    return request.app.token_cache
+
+
+async def profile_cache(request: Request) -> TTLCache:
+    return request.app.profile_cache
+
+
+async def queue_engine(request: Request) -> QueueEngine:
+    return request.app.queue_engine
+
+
+async def realtime_publisher(request: Request) -> Debouncer:
+    return request.app.realtime_publisher
+
+
+async def room_mirror(request: Request) -> MirrorEngine:
+    return request.app.room_mirror
+
+
+async def realtime_snapshots(request: Request) -> TTLCache:
+    return request.app.realtime_snapshots
+
+
+async def realtime_locks(request: Request) -> KeyedLocks:
+    return request.app.realtime_locks
+
+
+async def realtime_rooms(request: Request) -> SnapshotCache:
+    return request.app.realtime_rooms
+
+
+async def push_dispatcher(request: Request) -> PushDispatcher:
+    return request.app.push_dispatcher
+
+
+async def push_throttle(request: Request) -> PushThrottle:
+    return request.app.push_throttle
+
+
+async def settings(request: Request):
     return request.app.settings
 
 
+def async_firestore_client() -> AsyncClient:
+    """
+    firebase_admin only builds the blocking Firestore client,
+    async one uses credentials of the same default firebase app.
+    """
+    app = firebase_admin.get_app()
+    return AsyncClient(
+        project=app.project_id,
+        credentials=app.credential.get_credential(),
+    )
+
+
 def connect(
     app: FastAPI,
     auth_module=auth,
     firestore_module=firestore,
     messaging_module=messaging,
+    realtime_db_module=db,
     app_settings=config.get_settings(),
+    firestore_async_client=None,
 ):
     app.auth_transport = auth_module
     app.firestore_transport = firestore_module.client()
+    if firestore_async_client is None and app_settings.firestore_async:
+        firestore_async_client = async_firestore_client()
+    app.firestore_async_transport = firestore_async_client
     app.messaging_transport = messaging_module
-    app.realtime_db_transport = db
+    app.realtime_db_transport = realtime_db_module
     app.settings = app_settings
+    app.token_cache = TTLCache(
+        maxsize=app_settings.token_cache_size,
+        ttl=app_settings.token_cache_ttl,
+    )
+    app.profile_cache = TTLCache(
+        maxsize=app_settings.profile_cache_size,
+        ttl=app_settings.profile_cache_ttl,
+    )
+    app.realtime_snapshots = TTLCache(
+        maxsize=app_settings.realtime_snapshot_rooms,
+        ttl=app_settings.realtime_snapshot_ttl,
+    )
+    app.realtime_locks = KeyedLocks()
+    app.realtime_rooms = SnapshotCache(
+        maxsize=app_settings.realtime_room_cache_size,
+        ttl=app_settings.realtime_room_cache_ttl,
+    )
+    app.realtime_publisher = Debouncer(
+        window=app_settings.realtime_debounce_window,
+        max_delay=app_settings.realtime_debounce_max_delay,
+    )
+    app.queue_engine = QueueEngine(
+        reconcile_interval=app_settings.queue_reconcile_interval,
+        max_rooms=app_settings.queue_max_rooms,
+    )
+    app.room_mirror = MirrorEngine(
+        app.firestore_transport,
+        app.queue_engine,
+        enabled=app_settings.room_mirror,
+        max_rooms=app_settings.room_mirror_max_rooms,
+    )
+    app.push_dispatcher = PushDispatcher(
+        messaging_module,
+        workers=app_settings.push_workers,
+        max_pending=app_settings.push_queue_size,
+        retries=app_settings.push_retries,
+        retry_delay=app_settings.push_retry_delay,
+        enqueue_timeout=app_settings.push_enqueue_timeout,
+    )
+    app.push_throttle = PushThrottle(
+        app.push_dispatcher,
+        window=app_settings.push_coalesce_window,
+    )
+    app.add_event_handler('shutdown', app.push_throttle.flush)
+    app.add_event_handler('shutdown', app.push_dispatcher.close)
+    app.add_event_handler('shutdown', app.realtime_publisher.flush)
+    app.add_event_handler('shutdown', app.room_mirror.close)
@@ -1,11 +1,11 @@
 import pytest
-from datetime import datetime
+from datetime import datetime, timezone
 from fastapi.testclient import TestClient
 from firebase_admin import auth, messaging
-from mockfirestore import MockFirestore
 from unittest.mock import MagicMock
 
 from src import factory, schemas, services, config
+from src.tests.utils import MockFirestore, MockRealtimeDb
 
 
 @pytest.fixture
@@ -15,6 +15,11 @@ def firestore():
     db.reset()
 
 
+@pytest.fixture
+def realtime_db():
+    return MockRealtimeDb()
+
+
 @pytest.fixture
 def send_multicast_success_count():
     return 0
@@ -80,10 +85,15 @@ def settings():
     return config.Settings()
 
 
+@pytest.fixture
+def firestore_async_client():
+    return None
+
+
 @pytest.fixture
 def app(
     firestore, messaging_transport,
-    auth_transport, settings,
+    auth_transport, realtime_db, settings, firestore_async_client,
 ):
     firestore_module = MagicMock()
     firestore_module.client.return_value = firestore
@@ -94,7 +104,9 @@ def app(
         firestore_module=firestore_module,
         auth_module=auth_transport,
         messaging_module=messaging_transport,
+        realtime_db_module=realtime_db,
         app_settings=settings,
+        firestore_async_client=firestore_async_client,
     )
     return api_app
 
@@ -172,12 +184,12 @@ def rooms(firestore, instructor_one_profile, instructor_two_profile):
     _, alpha_ref = firestore.collection('rooms').add({
         'name': 'test room 1',
         'profile_id': instructor_one_profile.id,
-        'created': datetime(2021, 1, 1),
+        'created': datetime(2021, 1, 1, tzinfo=timezone.utc),
     })
     _, bravo_ref = firestore.collection('rooms').add({
         'name': 'test room 2',
         'profile_id': instructor_two_profile.id,
-        'created': datetime(2021, 1, 2),
+        'created': datetime(2021, 1, 2, tzinfo=timezone.utc),
     })
 
     return alpha_ref, bravo_ref
@@ -204,36 +216,39 @@ def attendees(
         'name': student_one_profile.display_name,
         'profile_id': student_one_profile.id,
         'room_id': rooms[0].id,
-        'created': datetime(2021, 1, 3),
+        'created': datetime(2021, 1, 3, tzinfo=timezone.utc),
         'hand_up': False,
         'hand_change_timestamp': None,
         'answering': False,
         'answers': 0,
         'room_owner_likes': 0,
-        'peer_likes': 0
+        'peer_likes': 0,
+        'random_key': 0.25,
     })
     _, alpha_ref = firestore.collection('attendees').add({
         'name': student_two_profile.display_name,
         'profile_id': student_two_profile.id,
         'room_id': rooms[0].id,
-        'created': datetime(2021, 1, 2),
+        'created': datetime(2021, 1, 2, tzinfo=timezone.utc),
         'hand_up': False,
         'hand_change_timestamp': None,
         'answering': False,
         'answers': 0,
         'room_owner_likes': 0,
-        'peer_likes': 0
+        'peer_likes': 0,
+        'random_key': 0.5,
     })
     _, bravo_ref = firestore.collection('attendees').add({
         'name': 'bravo',
         'profile_id': 'bravo',
         'room_id': rooms[1].id,
-        'created': datetime(2021, 1, 1),
+        'created': datetime(2021, 1, 1, tzinfo=timezone.utc),
         'hand_up': False,
         'hand_change_timestamp': None,
         'answering': False,
         'answers': 0,
         'room_owner_likes': 0,
-        'peer_likes': 0
+        'peer_likes': 0,
+        'random_key': 0.75,
     })
     return test_ref, alpha_ref, bravo_ref
@@ -0,0 +1,61 @@
+import pytest
+from unittest.mock import ANY
+
+from src.tests.utils import AsyncMockFirestore
+
+
+@pytest.fixture
+def firestore_async_client(firestore):
+    return AsyncMockFirestore(firestore)
+
+
+def test_list_rooms_pages(student_one, rooms):
+    response = student_one.get("/api/v1/rooms?limit=1")
+    assert response.status_code == 200
+    first_page = response.json()
+    assert [r['name'] for r in first_page['result']] == ['test room 1']
+
+    response = student_one.get(
+        f"/api/v1/rooms?limit=1&cursor={first_page['cursor']}"
+    )
+    assert [r['name'] for r in response.json()['result']] == ['test room 2']
+
+
+def test_list_joined_rooms(student_one, rooms, attendees):
+    response = student_one.get("/api/v1/rooms?relation=joined")
+    assert response.status_code == 200
+    assert [r['id'] for r in response.json()['result']] == [rooms[0].id]
+
+
+def test_list_attendees_in_room(instructor_one, rooms, attendees):
+    response = instructor_one.get(f"/api/v1/attendees/?room_id={rooms[0].id}")
+    assert response.status_code == 200
+    assert [a['name'] for a in response.json()['result']] == [
+        'Test Student One', 'Test Student Two',
+    ]
+
+
+def test_notification_token_lifecycle(
+    instructor_one,
+    instructor_one_profile,
+    firestore,
+):
+    response = instructor_one.post(
+        "/api/v1/profile/notification_tokens",
+        json={'token': 'abc'},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        'id': 'abc',
+        'profile_id': instructor_one_profile.id,
+        'created': ANY,
+        'last_message_timestamp': None,
+        'message_count': 0,
+    }
+
+    response = instructor_one.get("/api/v1/profile/notification_tokens")
+    assert [t['id'] for t in response.json()['result']] == ['abc']
+
+    response = instructor_one.delete("/api/v1/profile/notification_tokens/abc")
+    assert response.status_code == 204
+    assert not firestore.collection('notification_tokens').document('abc').get().exists
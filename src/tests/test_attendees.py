@@ -1,20 +1,38 @@
+import threading
+import pytest
 from freezegun import freeze_time
-from datetime import datetime
+from datetime import datetime, timezone
 from unittest.mock import ANY
 
+from mockfirestore import DocumentReference
+
+from src import firestore as crud_module
+from src.cache import KeyedLocks, SnapshotCache, TTLCache
+from src import realtime_db as realtime_module
+
+
+def content_paths(writes: list) -> list[list[str]]:
+    """
+    Paths of realtime updates without the versions written with keyed nodes.
+    """
+    return [
+        sorted(path for path in value if f'/{realtime_module.VERSIONS}/' not in path)
+        for _, _, value in writes
+    ]
+
 
 def test_list_all_attendees(instructor_one, attendees):
     response = instructor_one.get("/api/v1/attendees/")
     assert response.status_code == 200
     assert response.json() == {
-        'cursor': 'not-implemented',
+        'cursor': None,
         'result': [
             {
                 'id': ANY,
                 'name': 'Test Student One',
                 'profile_id': ANY,
                 'room_id': ANY,
-                'created': '2021-01-03T00:00:00',
+                'created': '2021-01-03T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -27,7 +45,7 @@ def test_list_all_attendees(instructor_one, attendees):
                 'name': 'Test Student Two',
                 'profile_id': ANY,
                 'room_id': ANY,
-                'created': '2021-01-02T00:00:00',
+                'created': '2021-01-02T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -40,7 +58,7 @@ def test_list_all_attendees(instructor_one, attendees):
                 'name': 'bravo',
                 'profile_id': 'bravo',
                 'room_id': ANY,
-                'created': '2021-01-01T00:00:00',
+                'created': '2021-01-01T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -56,14 +74,14 @@ def test_list_attendees_in_room(instructor_one, rooms, attendees):
     response = instructor_one.get(f"/api/v1/attendees/?room_id={rooms[0].id}")
     assert response.status_code == 200
     assert response.json() == {
-        'cursor': 'not-implemented',
+        'cursor': None,
         'result': [
             {
                 'id': ANY,
                 'name': 'Test Student One',
                 'profile_id': ANY,
                 'room_id': rooms[0].id,
-                'created': '2021-01-03T00:00:00',
+                'created': '2021-01-03T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -76,7 +94,7 @@ def test_list_attendees_in_room(instructor_one, rooms, attendees):
                 'name': 'Test Student Two',
                 'profile_id': ANY,
                 'room_id': rooms[0].id,
-                'created': '2021-01-02T00:00:00',
+                'created': '2021-01-02T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -92,14 +110,14 @@ def test_list_attendees_with_limit(instructor_one, rooms, attendees):
     response = instructor_one.get("/api/v1/attendees/?limit=1")
     assert response.status_code == 200
     assert response.json() == {
-        'cursor': 'not-implemented',
+        'cursor': ANY,
         'result': [
             {
                 'id': ANY,
                 'name': 'Test Student One',
                 'profile_id': ANY,
                 'room_id': rooms[0].id,
-                'created': '2021-01-03T00:00:00',
+                'created': '2021-01-03T00:00:00+00:00',
                 'hand_up': False,
                 'answering': False,
                 'answers': 0,
@@ -111,6 +129,39 @@ def test_list_attendees_with_limit(instructor_one, rooms, attendees):
     }
 
 
+def test_list_attendees_pages(instructor_one, rooms, attendees):
+    names = []
+    cursor = None
+    for _ in range(3):
+        params = {'limit': 2}
+        if cursor:
+            params['cursor'] = cursor
+        response = instructor_one.get("/api/v1/attendees/", params=params)
+        assert response.status_code == 200
+        names.extend(a['name'] for a in response.json()['result'])
+        cursor = response.json()['cursor']
+        if not cursor:
+            break
+
+    assert names == ['Test Student One', 'Test Student Two', 'bravo']
+    assert cursor is None
+
+
+# missing document, 'a/b' and '.' which can't name a document
+@pytest.mark.parametrize('cursor', ['bWlzc2luZw==', 'YS9i', 'Lg=='])
+def test_list_attendees_invalid_cursor(instructor_one, attendees, cursor):
+    response = instructor_one.get(f"/api/v1/attendees/?cursor={cursor}")
+    assert response.status_code == 400
+    assert response.json() == {'detail': f'Cursor {cursor} is not valid.'}
+
+
+@pytest.mark.parametrize('doc_id', ['a/b', '', '.', '..'])
+def test_cursor_of_invalid_document_id(doc_id):
+    with pytest.raises(crud_module.InvalidCursor):
+        crud_module.decode_cursor(crud_module.encode_cursor(doc_id))
+    assert crud_module.decode_cursor(crud_module.encode_cursor('abc')) == 'abc'
+
+
 @freeze_time('2021-01-01')
 def test_create_attendee(student_one, student_one_profile, rooms):
     response = student_one.post(
@@ -123,7 +174,7 @@ def test_create_attendee(student_one, student_one_profile, rooms):
         'profile_id': student_one_profile.id,
         'room_id': rooms[1].id,
         'answers': 0,
-        'created': '2021-01-01T00:00:00',
+        'created': '2021-01-01T00:00:00+00:00',
         'hand_change_timestamp': None,
         'hand_up': False,
         'answering': False,
@@ -141,7 +192,7 @@ def test_get_attendee(student_one, student_one_profile, rooms, attendees):
         'profile_id': student_one_profile.id,
         'room_id': ANY,
         'answers': 0,
-        'created': '2021-01-03T00:00:00',
+        'created': '2021-01-03T00:00:00+00:00',
         'hand_change_timestamp': None,
         'hand_up': False,
         'answering': False,
@@ -186,8 +237,8 @@ def test_attendee_hand_toggle(
         'profile_id': student_one_profile.id,
         'room_id': ANY,
         'answers': 0,
-        'created': '2021-01-03T00:00:00',
-        'hand_change_timestamp': '2021-01-04T00:00:00',
+        'created': '2021-01-03T00:00:00+00:00',
+        'hand_change_timestamp': '2021-01-04T00:00:00+00:00',
         'hand_up': True,
         'answering': False,
         'name': student_one_profile.display_name,
@@ -196,7 +247,7 @@ def test_attendee_hand_toggle(
     }
     doc_fields = attendees[0].get().to_dict()
     assert doc_fields['hand_up'] is True
-    assert doc_fields['hand_change_timestamp'] == datetime(2021, 1, 4)
+    assert doc_fields['hand_change_timestamp'] == datetime(2021, 1, 4, tzinfo=timezone.utc)
 
 
 @freeze_time('2021-01-04')
@@ -217,3 +268,194 @@ def test_attendee_hand_toggle_permission_error(
     assert doc_fields['hand_up'] is False
     assert doc_fields['hand_change_timestamp'] is None
 
+
+def test_hand_toggle_sends_realtime_delta(
+    app,
+    student_one,
+    attendees,
+    realtime_db,
+):
+    attendee_id = attendees[0].id
+    room_id = attendees[0].get().to_dict()['room_id']
+    for _ in range(3):
+        response = student_one.put(f"/api/v1/attendees/{attendee_id}/hand_toggle")
+        assert response.status_code == 200
+        app.realtime_publisher.flush()
+
+    # first sync doesn't know what clients have, later ones send only the change
+    assert content_paths(realtime_db.writes) == [
+        [f'rooms/{room_id}/queue'],
+        [f'rooms/{room_id}/queue/{attendee_id}'],
+        [f'rooms/{room_id}/queue/{attendee_id}'],
+    ]
+    queue = realtime_db.reference(f'rooms/{room_id}/queue').get()
+    assert list(queue) == [attendee_id]
+    assert queue[attendee_id]['hand_up'] is True
+
+
+def test_hand_toggle_room_reads(
+    student_one,
+    rooms,
+    attendees,
+    monkeypatch,
+):
+    rooms[0].update({'attendee_count': 2, 'hand_up_count': 0, 'answering_id': None})
+    reads = []
+    get = DocumentReference.get
+
+    def counting_get(ref, *args, **kwargs):
+        reads.append(ref._path[0])
+        return get(ref, *args, **kwargs)
+    monkeypatch.setattr(DocumentReference, 'get', counting_get)
+
+    response = student_one.put(f"/api/v1/attendees/{attendees[0].id}/hand_toggle")
+    assert response.status_code == 200
+    assert response.json()['hand_up'] is True
+    # fetch_room and the instructor notification,
+    # the transaction increments counters without reading the room
+    assert reads.count('rooms') == 2
+    assert rooms[0].get().to_dict()['hand_up_count'] == 1
+
+
+def test_import_attendees(
+    instructor_one,
+    rooms,
+    attendees,
+    student_one_profile,
+    instructor_two_profile,
+    firestore,
+    realtime_db,
+):
+    room_id = rooms[0].id
+    firestore.collection('rooms').document(room_id).update(
+        {'attendee_count': 2, 'hand_up_count': 0, 'answering_id': None},
+    )
+    response = instructor_one.post(
+        f"/api/v1/rooms/{room_id}/attendees",
+        json={'profile_ids': [
+            instructor_two_profile.id,
+            student_one_profile.id,
+            'missing',
+            instructor_two_profile.id,
+        ]},
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert [(a['profile_id'], a['room_id']) for a in result['created']] == [
+        (instructor_two_profile.id, room_id),
+    ]
+    assert result['existing'] == [student_one_profile.id]
+    assert result['missing'] == ['missing']
+
+    created = firestore.collection('attendees').document(result['created'][0]['id'])
+    assert created.get().to_dict()['name'] == instructor_two_profile.display_name
+    room = firestore.collection('rooms').document(room_id).get().to_dict()
+    assert room['attendee_count'] == 3
+    assert content_paths(realtime_db.writes) == [[f'rooms/{room_id}/attendees']]
+
+
+def test_import_attendees_permission_error(
+    instructor_two,
+    rooms,
+    student_one_profile,
+    firestore,
+):
+    response = instructor_two.post(
+        f"/api/v1/rooms/{rooms[0].id}/attendees",
+        json={'profile_ids': [student_one_profile.id]},
+    )
+    assert response.status_code == 403
+    assert not list(firestore.collection('attendees').stream())
+
+
+def test_hand_toggle_burst_is_written_once(
+    app,
+    student_one,
+    attendees,
+    realtime_db,
+):
+    app.realtime_publisher.window = 5
+    attendee_id = attendees[0].id
+    room_id = attendees[0].get().to_dict()['room_id']
+    for _ in range(3):
+        response = student_one.put(f"/api/v1/attendees/{attendee_id}/hand_toggle")
+        assert response.status_code == 200
+    assert realtime_db.writes == []
+
+    app.realtime_publisher.flush()
+    assert content_paths(realtime_db.writes) == [[f'rooms/{room_id}/queue']]
+    assert list(realtime_db.reference(f'rooms/{room_id}/queue').get()) == [attendee_id]
+
+
+def test_concurrent_realtime_syncs_of_a_room(app, firestore, realtime_db):
+    def crud():
+        return realtime_module.Crud(
+            crud_module.Crud(firestore), realtime_db, app.queue_engine, app.realtime_snapshots,
+            app.realtime_rooms, app.room_mirror, app.realtime_publisher,
+            app.realtime_locks,
+        )
+
+    computing = threading.Event()
+    go = threading.Event()
+
+    def slow_empty_queue():
+        # computed before b raised the hand, stored after
+        computing.set()
+        go.wait(5)
+        return {}
+
+    path = 'rooms/room/queue'
+    first = threading.Thread(
+        target=crud()._write, args=(path, realtime_module.Keyed(slow_empty_queue)),
+    )
+    second = threading.Thread(
+        target=crud()._write, args=(path, realtime_module.Keyed(lambda: {'b': {'id': 'b'}})),
+    )
+    first.start()
+    computing.wait(5)
+    second.start()
+    second.join(0.1)
+    go.set()
+    first.join()
+    second.join()
+    assert realtime_db.reference(path).get() == {'b': {'id': 'b'}}
+
+    # b lowers the hand
+    crud()._write(path, realtime_module.Keyed(lambda: {}))
+    assert not realtime_db.reference(path).get()
+
+
+def test_realtime_syncs_of_two_processes(app, firestore, realtime_db):
+    def process():
+        # own snapshots, cache and locks, one realtime db
+        return realtime_module.Crud(
+            crud_module.Crud(firestore), realtime_db, app.queue_engine, TTLCache(),
+            SnapshotCache(), app.room_mirror, app.realtime_publisher, KeyedLocks(),
+        )
+
+    def queue(*ids):
+        return realtime_module.Keyed(lambda: {i: {'id': i} for i in ids})
+
+    path = 'rooms/room/queue'
+    a, b = process(), process()
+    a._write(path, queue('x'))
+    b._write(path, queue())
+    a._write(path, queue('x'))
+    assert realtime_db.reference(path).get() == {'x': {'id': 'x'}}
+
+    # a rewrites the queue between the version check and the diff of b
+    b._write(path, queue('x'))
+    stored_versions = b._stored_versions
+
+    def racing(room_id):
+        versions = stored_versions(room_id)
+        a._write(path, queue('y'))
+        return versions
+    b._stored_versions = racing
+    b._write(path, queue('x', 'z'))
+    assert len(realtime_db.reference('rooms/room/versions/queue').get()) == 2
+
+    # neither trusts its snapshot now, the next write sends everything
+    a._write(path, queue('y'))
+    assert realtime_db.reference(path).get() == {'y': {'id': 'y'}}
+    assert len(realtime_db.reference('rooms/room/versions/queue').get()) == 1
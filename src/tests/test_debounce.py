@@ -0,0 +1,41 @@
+from time import sleep
+
+from src.debounce import Debouncer
+
+
+def wait_for(condition, timeout: float = 2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        sleep(0.01)
+
+
+def test_debouncer_runs_last_call_once():
+    calls = []
+    debouncer = Debouncer(window=0.05, max_delay=1)
+    for i in range(5):
+        debouncer.call('room', lambda i=i: calls.append(i))
+    debouncer.call('other', lambda: calls.append('other'))
+    wait_for(lambda: len(calls) == 2)
+    sleep(0.1)
+    assert sorted(calls, key=str) == [4, 'other']
+
+
+def test_debouncer_max_delay():
+    calls = []
+    debouncer = Debouncer(window=10, max_delay=0.05)
+    debouncer.call('room', lambda: calls.append(1))
+    debouncer.call('room', lambda: calls.append(2))
+    wait_for(lambda: calls)
+    assert calls == [2]
+
+
+def test_debouncer_flush_and_zero_window():
+    calls = []
+    debouncer = Debouncer(window=10)
+    debouncer.call('room', lambda: calls.append(1))
+    debouncer.flush()
+    assert calls == [1]
+
+    Debouncer(window=0).call('room', lambda: calls.append(2))
+    assert calls == [1, 2]
@@ -10,3 +10,23 @@ def test_instructor_health(instructor_one):
     response = instructor_one.get("/api/v1/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
+
+
+def test_cache_control(guest, instructor_one, room_one, realtime_db):
+    realtime_db.reference(f'rooms/{room_one.id}').set(
+        {'profile_id': 'instructor_one', 'name': 'test room 1'}
+    )
+
+    response = guest.get("/api/v1/health")
+    assert response.headers['cache-control'] == 'public, max-age=5'
+
+    response = instructor_one.get("/api/v1/rooms")
+    assert response.headers['cache-control'] == 'no-store'
+
+    response = instructor_one.get(f"/api/v1/realtime_room_format/{room_one.id}")
+    assert response.status_code == 200
+    assert response.headers['cache-control'] == 'private, no-cache'
+
+    response = instructor_one.get("/api/v1/realtime_room_format/missing")
+    assert response.status_code == 404
+    assert response.headers['cache-control'] == 'no-store'
@@ -1,6 +1,14 @@
+import threading
 import pytest
 from freezegun import freeze_time
-from datetime import datetime
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+from firebase_admin import exceptions
+from firebase_admin.messaging import SendResponse, UnregisteredError
+
+from src.dispatch import PushDispatcher, PushThrottle, MULTICAST_LIMIT, dead_tokens
+from src.messaging import Message
 
 
 @pytest.fixture
@@ -17,14 +25,14 @@ def message_tokens(
     ref_one = firestore.collection('notification_tokens').document('abc')
     ref_one.set({
         'profile_id': instructor_one_profile.id,
-        'created': datetime(2021, 1, 1),
+        'created': datetime(2021, 1, 1, tzinfo=timezone.utc),
         'message_count': 0,
         'last_message_timestamp': None,
     })
     ref_two = firestore.collection('notification_tokens').document('xyz')
     ref_two.set({
         'profile_id': instructor_two_profile.id,
-        'created': datetime(2021, 1, 1),
+        'created': datetime(2021, 1, 1, tzinfo=timezone.utc),
         'message_count': 0,
         'last_message_timestamp': None,
     })
@@ -38,14 +46,17 @@ def test_send_message_on_hand_up(
     attendees,
     message_tokens,
     messaging_transport,
+    app,
 ):
     response = student_one.put(
         f"/api/v1/attendees/{attendees[0].id}/hand_toggle",
     )
     assert response.status_code == 200
+    # push goes out after the response
+    app.push_dispatcher.join()
     doc_fields = attendees[0].get().to_dict()
     assert doc_fields['hand_up'] is True
-    assert doc_fields['hand_change_timestamp'] == datetime(2021, 1, 4)
+    assert doc_fields['hand_change_timestamp'] == datetime(2021, 1, 4, tzinfo=timezone.utc)
 
     # lib call to:
     # message = messaging.MulticastMessage(
@@ -66,7 +77,7 @@ def test_send_message_on_hand_up(
 
     token = message_tokens[0].get().to_dict()
     assert token['message_count'] == 1
-    assert token['last_message_timestamp'] == datetime(2021, 1, 4)
+    assert token['last_message_timestamp'] == datetime(2021, 1, 4, tzinfo=timezone.utc)
 
     token = message_tokens[1].get().to_dict()
     assert token['message_count'] == 0
@@ -81,12 +92,12 @@ def test_list_notification_tokens(
     response = instructor_one.get("/api/v1/profile/notification_tokens")
     assert response.status_code == 200
     assert response.json() == {
-        "cursor": "not-implemented",
+        'cursor': None,
         'result': [
             {
                 'id': 'abc',
                 'profile_id': instructor_one_profile.id,
-                'created': '2021-01-01T00:00:00',
+                'created': '2021-01-01T00:00:00+00:00',
                 'last_message_timestamp': None,
                 'message_count': 0,
             },
@@ -108,7 +119,7 @@ def test_create_notification_token(
     assert response.json() == {
         'id': 'abc',
         'profile_id': instructor_one_profile.id,
-        'created': '2021-01-01T00:00:00',
+        'created': '2021-01-01T00:00:00+00:00',
         'last_message_timestamp': None,
         'message_count': 0,
     }
@@ -116,7 +127,7 @@ def test_create_notification_token(
     doc = firestore.collection('notification_tokens').document('abc').get()
     assert doc.to_dict() == {
         'profile_id': instructor_one_profile.id,
-        'created': datetime(2021, 1, 1),
+        'created': datetime(2021, 1, 1, tzinfo=timezone.utc),
         'last_message_timestamp': None,
         'message_count': 0,
     }
@@ -155,3 +166,166 @@ def test_delete_other_owner_token_failure(
     assert doc.exists
     doc = firestore.collection('notification_tokens').document('xyz').get()
     assert doc.exists
+
+
+def test_push_retried_on_unavailable(messaging_transport):
+    response = messaging_transport.send_multicast.return_value
+    messaging_transport.send_multicast.side_effect = [
+        exceptions.UnavailableError('try later'),
+        response,
+    ]
+    on_sent = MagicMock()
+    dispatcher = PushDispatcher(messaging_transport, retry_delay=0)
+
+    assert dispatcher.submit([MagicMock(id='abc')], {'hand_up': 'x'}, on_sent)
+    dispatcher.join()
+    dispatcher.close()
+
+    assert messaging_transport.send_multicast.call_count == 2
+    on_sent.assert_called_once()
+    assert on_sent.call_args.args[1] is response
+
+
+def test_push_dropped_when_queue_is_full(messaging_transport):
+    sending = threading.Event()
+    release = threading.Event()
+
+    def send_multicast(message):
+        sending.set()
+        release.wait()
+    messaging_transport.send_multicast.side_effect = send_multicast
+    dispatcher = PushDispatcher(
+        messaging_transport, workers=1, max_pending=1, enqueue_timeout=0,
+    )
+    tokens = [MagicMock(id='abc')]
+
+    assert dispatcher.submit(tokens, {})
+    sending.wait(1)
+    assert dispatcher.submit(tokens, {})
+    assert not dispatcher.submit(tokens, {})
+    assert dispatcher.dropped == 1
+
+    release.set()
+    dispatcher.join()
+    dispatcher.close()
+    assert messaging_transport.send_multicast.call_count == 2
+
+
+@freeze_time('2021-01-04')
+def test_hand_ups_within_window_are_coalesced(
+    student_one,
+    attendees,
+    message_tokens,
+    messaging_transport,
+    app,
+):
+    for _ in range(3):
+        response = student_one.put(
+            f"/api/v1/attendees/{attendees[0].id}/hand_toggle",
+        )
+        assert response.status_code == 200
+    app.push_dispatcher.join()
+    # hand went up twice, only first one was sent right away
+    assert messaging_transport.send_multicast.call_count == 1
+
+    app.push_throttle.flush()
+    app.push_dispatcher.join()
+    assert messaging_transport.send_multicast.call_count == 2
+    _, kwargs = messaging_transport.MulticastMessage.call_args
+    assert kwargs == {
+        'data': {'hand_up': 'Test Student One'},
+        'tokens': ['abc'],
+    }
+
+
+def test_throttle_summarizes_per_token(messaging_transport):
+    dispatcher = PushDispatcher(messaging_transport)
+    throttle = PushThrottle(dispatcher, window=60)
+    recent = MagicMock(id='recent', last_message_timestamp=datetime.now())
+    idle = MagicMock(id='idle', last_message_timestamp=None)
+
+    assert throttle.notify([recent, idle], 'One', Message.hand_up_data)
+    assert not throttle.notify([recent, idle], 'Two', Message.hand_up_data)
+    assert not throttle.notify([recent, idle], 'Three', Message.hand_up_data)
+    throttle.flush()
+    dispatcher.join()
+    dispatcher.close()
+
+    sent = [
+        (kwargs['tokens'], kwargs['data'])
+        for _, kwargs in messaging_transport.MulticastMessage.call_args_list
+    ]
+    assert sent == [
+        (['idle'], {'hand_up': 'One'}),
+        (
+            ['recent'],
+            {'hand_up': 'One, Two, Three', 'hand_up_count': '3'},
+        ),
+        (['idle'], {'hand_up': 'Two, Three', 'hand_up_count': '2'}),
+    ]
+
+
+@freeze_time('2021-01-04')
+def test_dead_tokens_are_deleted(
+    student_one,
+    attendees,
+    message_tokens,
+    instructor_one_profile,
+    messaging_transport,
+    firestore,
+    app,
+):
+    firestore.collection('notification_tokens').document('dead').set({
+        'profile_id': instructor_one_profile.id,
+        'created': datetime(2021, 1, 2, tzinfo=timezone.utc),
+        'message_count': 3,
+        'last_message_timestamp': None,
+    })
+    response = messaging_transport.send_multicast.return_value
+    response.success_count = 1
+    response.responses = [
+        SendResponse({'name': 'message'}, None),
+        SendResponse(None, UnregisteredError('not registered')),
+    ]
+
+    response = student_one.put(f"/api/v1/attendees/{attendees[0].id}/hand_toggle")
+    assert response.status_code == 200
+    app.push_dispatcher.join()
+
+    _, kwargs = messaging_transport.MulticastMessage.call_args
+    assert kwargs['tokens'] == ['abc', 'dead']
+    tokens = {doc.id: doc.to_dict() for doc in firestore.collection('notification_tokens').stream()}
+    assert set(tokens) == {'abc', 'xyz'}
+    assert tokens['abc']['message_count'] == 1
+    assert tokens['abc']['last_message_timestamp'] == datetime(2021, 1, 4, tzinfo=timezone.utc)
+
+
+def test_invalid_argument_kills_tokens_only_next_to_successes():
+    tokens = ['abc', 'xyz']
+    invalid = SendResponse(None, exceptions.InvalidArgumentError('invalid'))
+
+    # the message itself was rejected, e.g. a too large payload
+    response = MagicMock(success_count=0, responses=[invalid, invalid])
+    assert dead_tokens(tokens, response) == []
+
+    response = MagicMock(success_count=1, responses=[SendResponse({'name': 'm'}, None), invalid])
+    assert dead_tokens(tokens, response) == ['xyz']
+
+    unregistered = SendResponse(None, UnregisteredError('not registered'))
+    response = MagicMock(success_count=0, responses=[invalid, unregistered])
+    assert dead_tokens(tokens, response) == ['xyz']
+
+
+def test_multicast_split_at_fcm_limit(messaging_transport):
+    dispatcher = PushDispatcher(messaging_transport)
+    tokens = [MagicMock(id=str(i)) for i in range(2 * MULTICAST_LIMIT + 1)]
+
+    assert dispatcher.submit(tokens, {'hand_up': 'x'})
+    dispatcher.join()
+    dispatcher.close()
+
+    sizes = sorted(
+        len(kwargs['tokens'])
+        for _, kwargs in messaging_transport.MulticastMessage.call_args_list
+    )
+    assert sizes == [1, MULTICAST_LIMIT, MULTICAST_LIMIT]
@@ -0,0 +1,116 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from google.cloud.firestore_v1.watch import ChangeType
+from mockfirestore.query import Query
+
+from src import queues
+from src.mirror import MirrorEngine
+
+
+@pytest.fixture
+def watches(monkeypatch):
+    """
+    Stand-in for Firestore watches, the first snapshot is delivered right away.
+    Return room id -> callback of the watch.
+    """
+    callbacks = {}
+    stream = Query.stream
+
+    def on_snapshot(query, callback):
+        docs = list(stream(query))
+        room_id = next(v for f, op, v in query._field_filters if f == 'room_id')
+        callbacks[room_id] = callback
+        callback(docs, [SimpleNamespace(type=ChangeType.ADDED, document=d) for d in docs], None)
+        return MagicMock(is_active=True)
+    monkeypatch.setattr(Query, 'on_snapshot', on_snapshot, raising=False)
+    return callbacks
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """
+    Queries of attendees by room.
+    """
+    streamed = []
+    stream = Query.stream
+
+    def counting_stream(query, *args, **kwargs):
+        if any(f == 'room_id' for f, _, _ in query._field_filters):
+            streamed.append(query)
+        return stream(query, *args, **kwargs)
+    monkeypatch.setattr(Query, 'stream', counting_stream)
+    return streamed
+
+
+def test_mirrored_room_syncs_without_queries(
+    app,
+    student_one,
+    rooms,
+    attendees,
+    firestore,
+    realtime_db,
+    watches,
+    queries,
+):
+    app.room_mirror.enabled = True
+    room_id = rooms[0].id
+    rooms[0].update({'attendee_count': 2, 'hand_up_count': 0, 'answering_id': None})
+
+    response = student_one.put(f"/api/v1/attendees/{attendees[0].id}/hand_toggle")
+    assert response.status_code == 200
+    response = student_one.post(f"/api/v1/realtime_room_update/{room_id}")
+    assert response.status_code == 200
+    assert list(response.json()['queue']) == [attendees[0].id]
+    assert len(response.json()['attendees']) == 2
+    assert room_id in watches
+    assert queries == []
+
+    # other processes' changes arrive through the watch
+    attendees[1].update({'hand_up': True})
+    watches[room_id](
+        [], [SimpleNamespace(type=ChangeType.MODIFIED, document=attendees[1].get())], None,
+    )
+    response = student_one.post(f"/api/v1/realtime_room_update/{room_id}")
+    assert set(response.json()['queue']) == {attendees[0].id, attendees[1].id}
+    assert queries == []
+
+
+def test_mirror_evicts_least_recently_used_rooms(firestore, rooms, attendees, watches):
+    engine = MirrorEngine(firestore, queues.QueueEngine(), enabled=True, max_rooms=1)
+    assert len(engine.attendees(rooms[0].id)) == 2
+    first = engine._mirrored(rooms[0].id)
+
+    assert [a.name for a in engine.attendees(rooms[1].id)] == ['bravo']
+    assert engine._mirrored(rooms[0].id) is None
+    first.watch.unsubscribe.assert_called_once()
+
+
+def test_disabled_mirror_is_not_used(firestore, rooms, watches):
+    engine = MirrorEngine(firestore, queues.QueueEngine())
+    assert engine.attendees(rooms[0].id) is None
+    assert watches == {}
+
+
+def test_next_attendee_updates_mirrored_attendees(
+    app,
+    instructor_one,
+    rooms,
+    attendees,
+    watches,
+):
+    app.room_mirror.enabled = True
+    room_id = rooms[0].id
+    attendees[0].update({'hand_up': True})
+    attendees[1].update({'answering': True})
+    assert len(app.room_mirror.attendees(room_id)) == 2
+
+    response = instructor_one.get(f"/api/v1/rooms/{room_id}/next_attendee")
+    assert response.status_code == 200
+    assert response.json()['id'] == attendees[0].id
+    # shown before the watch delivers the writes
+    mirrored = {a.id: a for a in app.room_mirror.attendees(room_id)}
+    started, stopped = mirrored[attendees[0].id], mirrored[attendees[1].id]
+    assert (started.answering, started.hand_up) == (True, False)
+    assert (stopped.answering, stopped.answers) == (False, 1)
@@ -1,7 +1,13 @@
+import random
 import pytest
 from unittest.mock import ANY
-from datetime import datetime
+from datetime import datetime, timezone
 from firebase_admin import auth
+from google.cloud.firestore import DELETE_FIELD
+from mockfirestore.query import Query
+
+from src import firestore as crud_module
+from src import queues, schemas
 
 
 @pytest.fixture
@@ -17,12 +23,13 @@ def current_answer(firestore, rooms, create_profile):
         'name': profile.display_name,
         'profile_id': profile.id,
         'room_id': rooms[0].id,
-        'created': datetime(2021, 1, 4),
+        'created': datetime(2021, 1, 4, tzinfo=timezone.utc),
         'hand_up': False,
         'answering': True,
         'answers': 0,
         'room_owner_likes': 0,
-        'peer_likes': 0
+        'peer_likes': 0,
+        'random_key': 0.9,
     })
     return ref
 
@@ -56,7 +63,7 @@ def test_least_answers_first(
     assert response.json() == {
         'answering': True,
         'answers': 1,
-        'created': '2021-01-03T00:00:00',
+        'created': '2021-01-03T00:00:00+00:00',
         'hand_change_timestamp': None,
         'hand_up': False,
         'id': ANY,
@@ -69,3 +76,208 @@ def test_least_answers_first(
     previous = current_answer.get().to_dict()
     assert previous['answering'] is False
     assert previous['answers'] == 1
+
+
+def test_queue_follows_hand_toggle(
+    app,
+    login,
+    student_one_record,
+    instructor_one_record,
+    attendees,
+    room_one,
+):
+    attendees[0].update({'answers': 1})
+    for attendee in attendees[:2]:
+        attendee.update({'hand_up': True})
+
+    # hand toggle sync loads the queue, later changes come from the endpoints only
+    student_one = login(student_one_record)
+    response = student_one.put(f"/api/v1/attendees/{attendees[0].id}/hand_toggle")
+    assert response.json()['hand_up'] is False
+    app.realtime_publisher.flush()
+    queue = app.queue_engine.room(room_one.id, loader=list)
+    assert [a.id for a in queue.attendees()] == [attendees[1].id]
+
+    response = student_one.put(f"/api/v1/attendees/{attendees[0].id}/hand_toggle")
+    assert response.json()['hand_up'] is True
+    assert [a.id for a in queue.attendees()] == [attendees[0].id, attendees[1].id]
+
+    instructor_one = login(instructor_one_record)
+    picked = []
+    for _ in range(3):
+        response = instructor_one.get(f"/api/v1/rooms/{room_one.id}/next_attendee")
+        assert response.status_code == 200
+        picked.append(response.json() and response.json()['id'])
+    assert picked == [attendees[0].id, attendees[1].id, None]
+    assert len(queue) == 0
+
+
+def test_first_arrived(instructor_one, attendees, room_one):
+    attendees[0].update({'hand_up': True, 'hand_change_timestamp': datetime(2021, 1, 5, tzinfo=timezone.utc)})
+    attendees[1].update({'hand_up': True, 'hand_change_timestamp': datetime(2021, 1, 4, tzinfo=timezone.utc)})
+
+    response = instructor_one.get(
+        f"/api/v1/rooms/{room_one.id}/next_attendee?order=first_arrived"
+    )
+    assert response.status_code == 200
+    assert response.json()['id'] == attendees[1].id
+
+
+def test_random_in_queue(instructor_one, attendees, room_one):
+    attendees[1].update({'hand_up': True})
+
+    response = instructor_one.get(
+        f"/api/v1/rooms/{room_one.id}/next_attendee?order=random_in_queue"
+    )
+    assert response.status_code == 200
+    assert response.json()['id'] == attendees[1].id
+
+
+@pytest.mark.parametrize('pivot, picked', [(0.1, 0), (0.3, 1), (0.6, 0)])
+def test_random_in_room(
+    instructor_one, attendees, room_one, monkeypatch, pivot, picked,
+):
+    monkeypatch.setattr(random, 'random', lambda: pivot)
+    response = instructor_one.get(
+        f"/api/v1/rooms/{room_one.id}/next_attendee?order=random_in_room"
+    )
+    assert response.status_code == 200
+    assert response.json()['id'] == attendees[picked].id
+
+
+def test_next_attendee_single_realtime_write(
+    instructor_one,
+    in_queue,
+    current_answer,
+    room_one,
+    realtime_db,
+):
+    response = instructor_one.get(f"/api/v1/rooms/{room_one.id}/next_attendee")
+    assert response.status_code == 200
+
+    assert len(realtime_db.writes) == 1
+    method, path, value = realtime_db.writes[0]
+    assert (method, path) == ('update', '')
+    assert set(value) == {
+        f'rooms/{room_one.id}/answering',
+        f'rooms/{room_one.id}/queue',
+        f'rooms/{room_one.id}/versions/queue',
+    }
+    room = realtime_db.reference(f'rooms/{room_one.id}').get()
+    assert room['answering']['id'] == in_queue[0].id
+    assert room['answering']['answering'] is True
+    assert list(room['queue']) == [in_queue[1].id]
+
+
+def test_next_attendee_skips_taken_attendee(
+    app,
+    instructor_one,
+    in_queue,
+    room_one,
+):
+    response = instructor_one.get(f"/api/v1/rooms/{room_one.id}/next_attendee")
+    assert response.json()['id'] == in_queue[0].id
+
+    # another process lowered the hand, this process' queue doesn't know yet
+    in_queue[1].update({'hand_up': False})
+    assert [a.id for a in app.queue_engine.room(room_one.id, list).attendees()] == [
+        in_queue[1].id,
+    ]
+
+    response = instructor_one.get(f"/api/v1/rooms/{room_one.id}/next_attendee")
+    assert response.status_code == 200
+    assert response.json() is None
+    assert in_queue[1].get().to_dict()['answering'] is False
+    assert in_queue[0].get().to_dict()['answering'] is False
+    assert len(app.queue_engine.room(room_one.id, list)) == 0
+
+
+def queued_attendee(**fields) -> schemas.Attendee:
+    return schemas.Attendee(**{
+        'id': 'a',
+        'name': 'A',
+        'profile_id': 'a',
+        'room_id': 'room',
+        'created': datetime(2021, 1, 1),
+        'hand_up': True,
+        'hand_change_timestamp': datetime(2021, 1, 2),
+        **fields,
+    })
+
+
+def test_queue_engine_updates_empty_loaded_room():
+    engine = queues.QueueEngine()
+    queue = engine.room('room', list)
+    engine.update(queued_attendee())
+    assert [a.id for a in queue.attendees()] == ['a']
+
+    engine.answered('room', ['a'])
+    assert queue.peek().answers == 1
+    engine.remove('room', 'a')
+    assert len(queue) == 0
+
+
+def test_room_queue_repush_with_same_key():
+    queue = queues.RoomQueue()
+    attendee = queued_attendee()
+    queue.push(attendee)
+    # the dead entry has the same key as the new one
+    queue.push(attendee.copy())
+    queue.push(schemas.Attendee.record_type()(attendee.__dict__))
+    assert [a.id for a in queue.attendees()] == ['a']
+    assert queue.peek().id == 'a'
+
+
+@pytest.fixture
+def missing_fields_skipped(monkeypatch):
+    """
+    Like Firestore, range filters skip documents without the field.
+    """
+    compare_func = Query._compare_func
+    monkeypatch.setattr(
+        Query, '_compare_func',
+        lambda query, op: lambda x, y: x is not None and compare_func(query, op)(x, y),
+    )
+
+
+def test_random_in_room_backfills_random_keys(
+    instructor_one, attendees, room_one, missing_fields_skipped,
+):
+    for attendee in attendees:
+        attendee.update({'random_key': DELETE_FIELD})
+    assert 'random_key' not in attendees[0].get().to_dict()
+
+    response = instructor_one.get(
+        f"/api/v1/rooms/{room_one.id}/next_attendee?order=random_in_room"
+    )
+    assert response.status_code == 200
+    assert response.json()['id'] in {attendees[0].id, attendees[1].id}
+    assert all('random_key' in a.get().to_dict() for a in attendees[:2])
+    # other rooms are left alone
+    assert 'random_key' not in attendees[2].get().to_dict()
+
+
+def test_random_in_room_backfills_mixed_room(
+    instructor_one, attendees, room_one, monkeypatch, missing_fields_skipped,
+):
+    # joined before random_key next to one who has it
+    attendees[1].update({'random_key': DELETE_FIELD})
+    url = f"/api/v1/rooms/{room_one.id}/next_attendee?order=random_in_room"
+    assert instructor_one.get(url).status_code == 200
+    key = attendees[1].get().to_dict()['random_key']
+    assert 'attendee_count' in room_one.reference.get().to_dict()
+
+    monkeypatch.setattr(random, 'random', lambda: key)
+    response = instructor_one.get(url)
+    assert response.status_code == 200
+    assert response.json()['id'] == attendees[1].id
+
+
+def test_advance_queue_restarts_answering_attendee(firestore, rooms, attendees):
+    attendees[0].update({'hand_up': True, 'answering': True, 'answers': 1})
+    crud = crud_module.Crud(firestore)
+
+    attendee, stopped = crud.advance_queue(rooms[0].id, attendees[0].id)
+    assert [(a.id, a.answering, a.answers) for a in stopped] == [(attendees[0].id, False, 2)]
+    assert (attendee.answering, attendee.hand_up, attendee.answers) == (True, False, 2)
+    assert attendees[0].get().to_dict()['answers'] == 2
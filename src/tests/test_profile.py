@@ -1,3 +1,6 @@
+from time import time
+from src import authorization
+
 
 def test_instructor_profile(instructor_one):
     response = instructor_one.get("/api/v1/profile")
@@ -23,3 +26,64 @@ def test_no_auth_error(guest):
     response = guest.get("/api/v1/profile")
     assert response.status_code == 401
     assert response.json() == {'detail': 'Not authenticated'}
+
+
+def test_verified_token_is_cached(
+    app,
+    instructor_one,
+    instructor_one_record,
+    auth_transport,
+):
+    auth_transport.verify_id_token.return_value = {
+        'uid': instructor_one_record.uid,
+        'exp': time() + 3600,
+    }
+    for _ in range(3):
+        response = instructor_one.get("/api/v1/profile")
+        assert response.status_code == 200
+
+    assert auth_transport.verify_id_token.call_count == 1
+    assert app.token_cache.hits == 2
+    assert app.token_cache.misses == 1
+
+
+def test_expired_token_is_not_cached(
+    app,
+    instructor_one,
+    instructor_one_record,
+    auth_transport,
+):
+    auth_transport.verify_id_token.return_value = {
+        'uid': instructor_one_record.uid,
+        'exp': time() - 1,
+    }
+    for _ in range(2):
+        response = instructor_one.get("/api/v1/profile")
+        assert response.status_code == 200
+
+    assert auth_transport.verify_id_token.call_count == 2
+    assert len(app.token_cache) == 0
+
+
+def test_profile_is_memoized(
+    app,
+    instructor_one,
+    instructor_one_record,
+    auth_transport,
+    firestore,
+):
+    for _ in range(2):
+        response = instructor_one.get("/api/v1/profile")
+        assert response.status_code == 200
+    assert auth_transport.get_user.call_count == 1
+
+    firestore.collection('profiles').document(instructor_one_record.uid).update(
+        {'display_name': 'Renamed Instructor'}
+    )
+    response = instructor_one.get("/api/v1/profile")
+    assert response.json()['display_name'] == 'Test Instructor One'
+
+    authorization.invalidate_profile(app.profile_cache, instructor_one_record.uid)
+    response = instructor_one.get("/api/v1/profile")
+    assert response.json()['display_name'] == 'Renamed Instructor'
+    assert auth_transport.get_user.call_count == 2
@@ -1,5 +1,9 @@
 from freezegun import freeze_time
+from mockfirestore import DocumentReference
 from unittest.mock import ANY
+from src import firestore as crud_module
+from src.cache import SnapshotCache
+from src.tests.utils import MockReference
 
 
 def test_list_rooms(
@@ -11,24 +15,44 @@ def test_list_rooms(
     response = student_one.get("/api/v1/rooms")
     assert response.status_code == 200
     assert response.json() == {
-        "cursor": "not-implemented",
+        'cursor': None,
         'result': [
             {
                 'id': ANY,
                 'name': 'test room 1',
                 'profile_id': instructor_one_profile.id,
-                'created': '2021-01-01T00:00:00',
+                'created': '2021-01-01T00:00:00+00:00',
             },
             {
                 'id': ANY,
                 'name': 'test room 2',
                 'profile_id': instructor_two_profile.id,
-                'created': '2021-01-02T00:00:00',
+                'created': '2021-01-02T00:00:00+00:00',
             },
         ]
     }
 
 
+def test_list_rooms_pages(student_one, rooms):
+    response = student_one.get("/api/v1/rooms?limit=1")
+    assert response.status_code == 200
+    first_page = response.json()
+    assert [r['name'] for r in first_page['result']] == ['test room 1']
+    assert first_page['cursor']
+
+    response = student_one.get(
+        f"/api/v1/rooms?limit=1&cursor={first_page['cursor']}"
+    )
+    assert response.status_code == 200
+    second_page = response.json()
+    assert [r['name'] for r in second_page['result']] == ['test room 2']
+
+    response = student_one.get(
+        f"/api/v1/rooms?limit=1&cursor={second_page['cursor']}"
+    )
+    assert response.json() == {'cursor': None, 'result': []}
+
+
 @freeze_time('2021-01-01')
 def test_create_room(instructor_one, instructor_one_profile):
     response = instructor_one.post(
@@ -40,7 +64,7 @@ def test_create_room(instructor_one, instructor_one_profile):
         'id': ANY,
         'name': 'test msd room',
         'profile_id': instructor_one_profile.id,
-        'created': '2021-01-01T00:00:00',
+        'created': '2021-01-01T00:00:00+00:00',
     }
 
 
@@ -83,3 +107,150 @@ def test_delete_other_owner_room_failure(instructor_one, rooms, firestore):
     rooms_left = list(firestore.collection('rooms').stream())
     assert len(rooms_left) == 2
 
+
+def test_delete_room_with_attendees(
+    instructor_one, rooms, attendees, firestore, realtime_db,
+):
+    realtime_db.reference(f'rooms/{rooms[0].id}').set({'name': 'test room 1'})
+    response = instructor_one.delete(f"/api/v1/rooms/{rooms[0].id}")
+    assert response.status_code == 204
+
+    attendees_left = list(firestore.collection('attendees').stream())
+    assert [a.id for a in attendees_left] == [attendees[2].id]
+    assert realtime_db.reference(f'rooms/{rooms[0].id}').get() is None
+
+
+def test_delete_room_in_batches(firestore, rooms, monkeypatch):
+    monkeypatch.setattr(crud_module, 'BATCH_SIZE', 3)
+    for i in range(5):
+        firestore.collection('attendees').add({'room_id': rooms[0].id, 'name': str(i)})
+
+    deleted = crud_module.Crud(firestore).delete_room(rooms[0].id)
+    assert deleted == 6
+    assert list(firestore.collection('attendees').stream()) == []
+    rooms_left = list(firestore.collection('rooms').stream())
+    assert [r.id for r in rooms_left] == [rooms[1].id]
+
+
+def test_list_joined_rooms(student_one, rooms, attendees):
+    response = student_one.get("/api/v1/rooms?relation=joined")
+    assert response.status_code == 200
+    assert [r['id'] for r in response.json()['result']] == [rooms[0].id]
+
+
+def test_fetch_rooms_keeps_order(firestore, rooms):
+    crud = crud_module.Crud(firestore)
+    ids = [rooms[1].id, 'missing', rooms[0].id, rooms[1].id]
+
+    fetched = crud.fetch_rooms(ids)
+    assert [r.id for r in fetched] == [rooms[1].id, rooms[0].id]
+
+    fetched = crud.fetch_rooms(ids, chunk_size=1)
+    assert [r.id for r in fetched] == [rooms[1].id, rooms[0].id]
+    assert crud.fetch_rooms([]) == []
+
+
+def test_room_counters(firestore, rooms, attendees, instructor_one_profile, monkeypatch):
+    crud = crud_module.Crud(firestore)
+    room_id = rooms[0].id
+    reads = []
+    get = DocumentReference.get
+
+    def counting_get(ref, *args, **kwargs):
+        reads.append(ref._path)
+        return get(ref, *args, **kwargs)
+
+    def stored():
+        fields = firestore.collection('rooms').document(room_id).get().to_dict()
+        return (
+            fields['attendee_count'], fields['hand_up_count'], fields['answering_id'],
+        )
+
+    # rooms created before counters existed are counted once, on first write
+    assert crud.get_room_counters(room_id).hand_up_count is None
+    attendee = crud.get_attendee(attendees[0].id)
+    crud.hand_toggle(attendee)
+    assert stored() == (2, 1, None)
+    monkeypatch.setattr(DocumentReference, 'get', counting_get)
+    assert crud.get_room_counters(room_id).hand_up_count == 1
+    assert crud.get_room_counters(room_id).hand_up_count == 1
+    crud.hand_toggle(crud.get_attendee(attendee.id))
+    crud.hand_toggle(crud.get_attendee(attendee.id))
+    # transactions increment the counters without reading the room
+    assert reads.count(['rooms', room_id]) == 1
+    monkeypatch.undo()
+
+    crud.start_answer(attendee.id)
+    assert stored() == (2, 0, attendee.id)
+    crud.stop_all_answers(room_id)
+    assert stored() == (2, 0, None)
+
+    crud.hand_toggle(crud.get_attendee(attendees[1].id))
+    crud.create_attendee(room_id, instructor_one_profile)
+    assert stored() == (3, 1, None)
+    crud.delete_attendee(attendees[1].id)
+    assert stored() == (2, 0, None)
+
+    counters = crud_module.Crud(firestore).get_room_counters(room_id)
+    assert (counters.attendee_count, counters.hand_up_count) == (2, 0)
+
+
+@freeze_time('2021-01-01')
+def test_create_room_starts_counters(instructor_one, instructor_one_profile, firestore):
+    response = instructor_one.post("/api/v1/rooms", json={'name': 'test msd room'})
+    assert response.status_code == 200
+
+    fields = firestore.collection('rooms').document(response.json()['id']).get().to_dict()
+    assert fields['attendee_count'] == 0
+    assert fields['hand_up_count'] == 0
+    assert fields['answering_id'] is None
+
+
+def test_realtime_room_etag(instructor_one, room_one, attendees, realtime_db, monkeypatch):
+    realtime_db.reference(f'rooms/{room_one.id}').set(
+        {'profile_id': 'instructor_one', 'name': 'test room 1'}
+    )
+    reads = []
+    get = MockReference.get
+
+    def counting_get(ref):
+        reads.append(ref.path)
+        return get(ref)
+    monkeypatch.setattr(MockReference, 'get', counting_get)
+
+    url = f"/api/v1/realtime_room_format/{room_one.id}"
+    response = instructor_one.get(url)
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert instructor_one.get(url).headers['etag'] == etag
+
+    response = instructor_one.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert response.content == b''
+    # later requests were answered from the process cache
+    assert reads == [f'rooms/{room_one.id}']
+
+    # writes of the process replace the cached room
+    assert instructor_one.post(f"/api/v1/realtime_room_update/{room_one.id}").status_code == 200
+    response = instructor_one.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+    assert len(response.json()['attendees']) == 2
+
+
+def test_snapshot_cache_skips_reads_older_than_invalidation():
+    cache = SnapshotCache(ttl=5)
+    with freeze_time('2021-01-01') as frozen:
+        started = cache.started()
+        frozen.tick()
+        cache.invalidate('room')
+        cache.set('room', 'old', started)
+        assert cache.get('room') is None
+
+        frozen.tick()
+        cache.set('room', 'new', cache.started())
+        assert cache.get('room') == 'new'
+
+        frozen.tick(5)
+        assert cache.get('room') is None
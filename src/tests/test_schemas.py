@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta, timezone
+from json import loads
+
+import pytest
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.firestore import Increment
+from google.cloud.firestore_v1._helpers import decode_value, encode_value
+from pydantic import ValidationError
+
+from src import firestore as crud_module
+from src import schemas
+
+
+def test_jsonable_matches_json_round_trip():
+    attendee = schemas.Attendee(
+        id='abc',
+        name='Test Student One',
+        profile_id='student_one',
+        room_id='room',
+        created=DatetimeWithNanoseconds(2021, 1, 3, 10, 5, 1, 1234, tzinfo=timezone.utc),
+        hand_up=True,
+        hand_change_timestamp=datetime(2021, 1, 4),
+        answers=2,
+    )
+    room = schemas.RealtimeRoom(
+        profile_id='instructor_one',
+        name='test room',
+        attendees={attendee.id: attendee},
+        queue=None,
+        answering=attendee,
+    )
+
+    assert schemas.jsonable(attendee) == loads(attendee.json())
+    assert schemas.jsonable(room) == loads(room.json())
+
+
+def test_trusted_snapshot_decode(firestore):
+    ref = firestore.collection('attendees').document('abc')
+    ref.set({
+        'name': 'Test Student One',
+        'profile_id': 'student_one',
+        'room_id': 'room',
+        'created': datetime(2021, 1, 3),
+        'hand_up': True,
+        'random_key': 0.5,
+    })
+    doc = ref.get()
+
+    validated = schemas.Attendee.from_snapshot(doc)
+    assert schemas.Attendee.from_snapshot(doc, trusted=True) == validated
+
+    record = schemas.Attendee.record_from_snapshot(doc)
+    assert record.id == 'abc' and record.answers == 0
+    assert record.to_model() == validated
+    assert schemas.jsonable(record) == schemas.jsonable(validated)
+    assert record.copy(update={'answers': 1}).answers == 1
+    with pytest.raises(AttributeError):
+        record.answers = 1
+
+
+def test_trusted_decode_validates_incomplete_documents(firestore):
+    ref = firestore.collection('attendees').document('abc')
+    ref.set({'name': 'Test Student One'})
+
+    with pytest.raises(ValidationError):
+        schemas.Attendee.from_snapshot(ref.get(), trusted=True)
+    with pytest.raises(ValidationError):
+        schemas.Attendee.record_from_snapshot(ref.get())
+
+
+def test_written_models_match_read_back(
+    firestore,
+    rooms,
+    attendees,
+    student_two_profile,
+    instructor_two_record,
+):
+    crud = crud_module.Crud(firestore)
+
+    def read_back(model, collection: str, doc_id: str):
+        # stored values pass through Firestore encoding, like a real read
+        doc = firestore.collection(collection).document(doc_id).get()
+        fields = {
+            field: decode_value(encode_value(value), None)
+            for field, value in doc.to_dict().items()
+        }
+        return model(id=doc_id, **fields)
+
+    room = crud.create_room(schemas.RoomCreate(name='written'), student_two_profile)
+    assert room == read_back(schemas.Room, 'rooms', room.id)
+
+    assert room.created.tzinfo == timezone.utc
+
+    attendee = crud.create_attendee(room.id, student_two_profile)
+    assert attendee == read_back(schemas.Attendee, 'attendees', attendee.id)
+    toggled = crud.hand_toggle(attendee)
+    assert toggled == read_back(schemas.Attendee, 'attendees', attendee.id)
+    imported = crud.create_attendees(room.id, [student_two_profile])
+    assert imported[0] == read_back(schemas.Attendee, 'attendees', imported[0].id)
+
+    token = crud.create_notification_token(student_two_profile, 'written_token')
+    assert token == read_back(schemas.NotificationToken, 'notification_tokens', token.id)
+
+    profile = crud.get_or_create_profile(instructor_two_record)
+    assert profile == read_back(schemas.Profile, 'profiles', profile.id)
+
+
+def test_written_datetimes_are_utc():
+    naive = datetime(2021, 1, 3, 10)
+    local = datetime(2021, 1, 3, 11, tzinfo=timezone(timedelta(hours=1)))
+    assert crud_module.written({'a': naive}, {'b': local}) == {
+        'a': datetime(2021, 1, 3, 10, tzinfo=timezone.utc),
+        'b': datetime(2021, 1, 3, 10, tzinfo=timezone.utc),
+    }
+    assert crud_module.written({'a': naive})['a'].tzinfo == timezone.utc
+
+
+def test_written_resolves_increment():
+    assert crud_module.written(
+        {'answers': Increment(1), 'answering': False},
+        {'answers': 2, 'answering': True, 'name': 'a'},
+    ) == {'answers': 3, 'answering': False, 'name': 'a'}
+    assert crud_module.written({'answers': Increment(2)}) == {'answers': 2}
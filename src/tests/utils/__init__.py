@@ -0,0 +1,166 @@
+from copy import deepcopy
+from typing import Any, Optional
+
+import mockfirestore
+from mockfirestore import Transaction
+
+
+class MockFirestore(mockfirestore.MockFirestore):
+    """
+    mockfirestore doesn't implement write batches,
+    but transaction has the same write api.
+    """
+    def batch(self) -> Transaction:
+        batch = Transaction(self)
+        batch._begin()
+        return batch
+
+
+class AsyncMockSnapshot:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.id = snapshot.id
+        self.exists = snapshot.exists
+        self.reference = AsyncMockDocument(snapshot.reference)
+
+    def to_dict(self) -> dict:
+        return self.snapshot.to_dict()
+
+
+class AsyncMockDocument:
+    def __init__(self, ref):
+        self.ref = ref
+        self.id = ref.id
+
+    async def get(self) -> AsyncMockSnapshot:
+        return AsyncMockSnapshot(self.ref.get())
+
+    async def set(self, data: dict, merge=False):
+        self.ref.set(data, merge=merge)
+
+    async def update(self, data: dict):
+        self.ref.update(data)
+
+    async def delete(self):
+        self.ref.delete()
+
+
+class AsyncMockQuery:
+    def __init__(self, query):
+        self.query = query
+
+    def where(self, *args) -> 'AsyncMockQuery':
+        return AsyncMockQuery(self.query.where(*args))
+
+    def order_by(self, *args, **kwargs) -> 'AsyncMockQuery':
+        return AsyncMockQuery(self.query.order_by(*args, **kwargs))
+
+    def limit(self, *args) -> 'AsyncMockQuery':
+        return AsyncMockQuery(self.query.limit(*args))
+
+    def start_after(self, doc: AsyncMockSnapshot) -> 'AsyncMockQuery':
+        return AsyncMockQuery(self.query.start_after(doc.snapshot))
+
+    async def stream(self):
+        for doc in self.query.stream():
+            yield AsyncMockSnapshot(doc)
+
+
+class AsyncMockCollection(AsyncMockQuery):
+    def document(self, document_id: Optional[str] = None) -> AsyncMockDocument:
+        return AsyncMockDocument(self.query.document(document_id))
+
+
+class AsyncMockBatch:
+    def __init__(self, batch: Transaction):
+        self.batch = batch
+
+    def set(self, ref: AsyncMockDocument, data: dict, merge=False):
+        self.batch.set(ref.ref, data, merge=merge)
+
+    def update(self, ref: AsyncMockDocument, data: dict):
+        self.batch.update(ref.ref, data)
+
+    def delete(self, ref: AsyncMockDocument):
+        self.batch.delete(ref.ref)
+
+    async def commit(self):
+        return self.batch.commit()
+
+
+class AsyncMockFirestore:
+    """
+    Async client api on top of the blocking mock, both share the same data.
+    """
+    def __init__(self, db: MockFirestore):
+        self.db = db
+
+    def collection(self, path: str) -> AsyncMockCollection:
+        return AsyncMockCollection(self.db.collection(path))
+
+    async def get_all(self, references: list[AsyncMockDocument]):
+        for doc in self.db.get_all([r.ref for r in references]):
+            yield AsyncMockSnapshot(doc)
+
+    def batch(self) -> AsyncMockBatch:
+        return AsyncMockBatch(self.db.batch())
+
+
+class MockReference:
+    def __init__(self, db: 'MockRealtimeDb', path: str):
+        self._db = db
+        self.path = path.strip('/')
+
+    @property
+    def _keys(self) -> list[str]:
+        return [k for k in self.path.split('/') if k]
+
+    def child(self, path: str) -> 'MockReference':
+        return MockReference(self._db, f'{self.path}/{path}')
+
+    def get(self) -> Any:
+        node = self._db.data
+        for key in self._keys:
+            if not isinstance(node, dict) or key not in node:
+                return None
+            node = node[key]
+        return deepcopy(node)
+
+    def set(self, value: Any) -> None:
+        self._db.writes.append(('set', self.path, deepcopy(value)))
+        self._set(self._keys, deepcopy(value))
+
+    def update(self, value: dict) -> None:
+        self._db.writes.append(('update', self.path, deepcopy(value)))
+        for path, item in value.items():
+            keys = self._keys + [k for k in path.split('/') if k]
+            self._set(keys, deepcopy(item))
+
+    def delete(self) -> None:
+        self._db.writes.append(('delete', self.path, None))
+        self._set(self._keys, None)
+
+    def _set(self, keys: list[str], value: Optional[Any]) -> None:
+        if not keys:
+            self._db.data = value if value is not None else {}
+            return
+        node = self._db.data
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        if value is None:
+            node.pop(keys[-1], None)
+        else:
+            node[keys[-1]] = value
+
+
+class MockRealtimeDb:
+    """
+    In memory stand-in for `firebase_admin.db`.
+    Every write is recorded in `writes` so tests can count round-trips.
+    """
+    def __init__(self):
+        self.data = {}
+        self.writes = []
+
+    def reference(self, path: str = '/') -> MockReference:
+        return MockReference(self, path)